@@ -19,6 +19,11 @@ hrds contains the following components:
     * buffer - functions to create buffer files
     * hdrs - the main hdrs object.
     * RasterInterpolator - objects to interpolate individual rasters
+    * DiskCache - a persistent cache of buffers and other files
+    * mosaic - join tiles into a single raster layer
+    * store - the file a raster stack is saved to by HRDS.save
+    * shared - arrays shared between processes
+    * node - stacks shared by the processes on a machine
 
 """
 
@@ -27,3 +32,4 @@ __version__ = "0.1.2"
 from .raster import RasterInterpolator   # NOQA
 from .raster_buffer import CreateBuffer  # NOQA
 from .hrds import HRDS                   # NOQA
+from .cache import DiskCache             # NOQA
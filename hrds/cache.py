@@ -0,0 +1,238 @@
+import hashlib
+import os
+import time
+import uuid
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+"""
+This module contains the DiskCache class, a directory of files that are
+expensive to create (such as buffer rasters) which can be shared between
+runs and between processes.
+"""
+
+
+class DiskCache():
+    """
+    Implements a persistent, size-limited, cache of files::
+
+        cache = DiskCache("/scratch/hrds_cache", max_bytes=10*1024**3)
+
+    Each entry is stored under a key, made with make_key() from whatever
+    determines its content, e.g.::
+
+        key = make_key("buffer", cache.signature("raster.tif"), 1, 500.0)
+        filename = cache.get(key, ".tif")
+        if filename is None:
+            filename = cache.put(key, ".tif", write_buffer)
+
+    where write_buffer is a function that writes the entry to the filename
+    it is given. Entries are written under a temporary name and then
+    renamed into place, so several processes can safely build the same
+    entry at once; the last one to finish wins, and they are identical.
+
+    When the cache is bigger than max_bytes, or entries are older than
+    max_age seconds, the least recently used entries are removed.
+
+    The default directory is $HRDS_CACHE_DIR, or ~/.cache/hrds if that
+    is not set. Source files are identified by their path, size and
+    modification time unless hash_content is True, in which case a hash
+    of their contents is used (which is robust to copying files about,
+    but slow for very large files).
+    """
+
+    def __init__(self, directory=None, max_bytes=None, max_age=None,
+                 hash_content=False):
+        """
+        Init our cache
+
+        Args:
+            directory: where to keep the cached files
+            max_bytes: the maximum total size of the cache. Default is None
+                (no limit)
+            max_age: the maximum time (seconds) since an entry was last
+                used. Default is None (no limit)
+            hash_content: identify source files by a hash of their
+                content, rather than their modification time.
+
+        Returns:
+            a DiskCache object
+        """
+        if directory is None:
+            directory = os.environ.get("HRDS_CACHE_DIR",
+                                       os.path.join(os.path.expanduser("~"),
+                                                    ".cache", "hrds"))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hash_content = hash_content
+        os.makedirs(self.directory, exist_ok=True)
+
+    def signature(self, filename):
+        """
+        Something that changes if the file changes.
+
+        Args:
+            filename: the file
+
+        Returns:
+            a string
+        """
+        if self.hash_content:
+            sha = hashlib.sha256()
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(1024*1024), b""):
+                    sha.update(chunk)
+            return sha.hexdigest()
+        stat = os.stat(filename)
+        return "{}:{}:{}".format(os.path.abspath(filename), stat.st_size,
+                                 stat.st_mtime_ns)
+
+    def filename(self, key, suffix):
+        """
+        Where an entry is (or would be) kept.
+
+        Args:
+            key: the key of the entry
+            suffix: the file extension, e.g. ".tif"
+
+        Returns:
+            the full filename
+        """
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix):
+        """
+        Look for an entry in the cache.
+
+        Args:
+            key: the key of the entry
+            suffix: the file extension, e.g. ".tif"
+
+        Returns:
+            the filename of the entry, or None if it isn't cached
+        """
+        filename = self.filename(key, suffix)
+        try:
+            # mark as recently used
+            os.utime(filename)
+        except OSError:
+            return None
+        return filename
+
+    def put(self, key, suffix, writer):
+        """
+        Create an entry in the cache.
+
+        Args:
+            key: the key of the entry
+            suffix: the file extension, e.g. ".tif"
+            writer: a function that writes the entry to the filename
+                given to it
+
+        Returns:
+            the filename of the entry
+        """
+        filename = self.filename(key, suffix)
+        temp_file = os.path.join(self.directory,
+                                 ".tmp-" + uuid.uuid4().hex + suffix)
+        try:
+            writer(temp_file)
+            os.replace(temp_file, filename)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        self.evict(keep=key)
+        return filename
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is within
+        its size and age limits. Temporary files left by processes that
+        died while writing are also removed.
+
+        Args:
+            keep: a key not to remove (e.g. the one just written)
+        """
+        now = time.time()
+        entries = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # someone else got there first
+                continue
+            if name.startswith(".tmp-"):
+                if now - stat.st_mtime > 24*3600:
+                    _remove(path)
+                continue
+            key = name.split(".")[0]
+            size, used, paths = entries.get(key, (0, 0, []))
+            entries[key] = (size + stat.st_size,
+                            max(used, stat.st_mtime), paths + [path])
+        total = sum(e[0] for e in entries.values())
+        # oldest first
+        for key, (size, used, paths) in sorted(entries.items(),
+                                               key=lambda e: e[1][1]):
+            if key == keep:
+                continue
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            too_old = self.max_age is not None and now - used > self.max_age
+            if not (too_big or too_old):
+                continue
+            for path in paths:
+                _remove(path)
+            total -= size
+
+
+def open_cache(cache):
+    """
+    Turn the ways a cache can be given into a DiskCache.
+
+    Args:
+        cache: None (no cache), True (a cache in the default directory),
+            a directory, or a DiskCache
+
+    Returns:
+        a DiskCache, or None
+    """
+    if cache is None or cache is False or isinstance(cache, DiskCache):
+        return cache
+    if cache is True:
+        return DiskCache()
+    return DiskCache(cache)
+
+
+def make_key(*parts):
+    """
+    Make a cache key from anything that can be turned into a string.
+
+    Args:
+        parts: the things the cached data depend on
+
+    Returns:
+        a string
+    """
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # already gone, or in use on some platforms
+        pass
@@ -1,8 +1,25 @@
-from .raster import RasterInterpolator
+from .raster import RasterInterpolator, QuantizedBand
 from .raster_buffer import CreateBuffer
+from .cache import make_key, open_cache
+from .mosaic import is_mosaic, build_mosaic, find_tiles
+from . import node
+from .spatial_index import CoverageIndex, RTree, curve_order, unique_points
+from .store import read_store, write_store
+from .shared import share_array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import threading
+import weakref
+import glob
+import hashlib
+import numpy as np
 import os
 from shutil import copyfile
-import tempfile
+try:
+    from osgeo import gdal
+except ImportError:
+    # only HRDS.load-ed stacks can be used
+    gdal = None
 try:
     from itertools import izip as zip
 except ImportError:  # will be 3.x series
@@ -26,6 +43,15 @@ except ImportError:  # will be 3.x series
 # create a hierarchy of rasters to pull data from, smoothly blending
 # between them
 
+# the size (in cells) of the tiles the buffer of a mosaic is created in
+MOSAIC_TILE = 2048
+# the number of points in each chunk of get_vals with workers
+CHUNK_SIZE = 65536
+# the version of the files HRDS.save writes
+STORE_VERSION = 1
+# the version of the values kept by result_cache
+RESULT_VERSION = 1
+
 
 class HRDSError(Exception):
     # any error generated by the RasterInterpolator object:
@@ -61,8 +87,9 @@ class HRDS():
     which would set a maximum depth of -5m on the gebco data (-ve = below
     sea level, +ve above), maximum of -3m on the emod data and no limits
     on the marine_digimap data. You must supply the same number of min-max
-    pairs are there are total rasters. Temporary buffer files will be created
-    and deleted at clean up
+    pairs are there are total rasters. The buffers are created in memory
+    unless saveBuffers is set, in which case they are also written next to
+    each raster as <raster>_buffer.tif
 
     If is possible to supply the buffer rasters directly (e.g. if you want
     to use different distances on each edge of your raster, or some other
@@ -81,6 +108,146 @@ class HRDS():
 
         bathy.get_val(100,100)
 
+    or at many points at once, which is much faster for large numbers
+    of points (e.g. all the nodes in a mesh):
+
+        bathy.get_vals([[100, 100], [200, 150]])
+
+    Very large rasters need not be loaded into memory in full. Setting
+    lazy=True reads each raster in blocks as queries touch them (see
+    RasterInterpolator).
+
+    If you only need data over a small part of the rasters, such as the
+    extent of your mesh, give a region of interest. This can be a bounding
+    box (xmin, ymin, xmax, ymax), or a polygon (a list of x,y vertices or
+    anything with a `bounds` attribute, such as a shapely geometry)::
+
+        bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "marine_digimap.tif"),
+             distances=(10000, 5000),
+             roi=[820000, 5840000, 845000, 5850000])
+
+    Only the part of each raster that covers the bounding box of the region
+    is then read, rasters outside it are ignored and buffers are only
+    created over the region. Points outside the region may then not be
+    found.
+
+    The region can also be the points that will be asked for, such as the
+    coordinates of a mesh. Under MPI, each rank can then give just the
+    coordinates of its own part of the mesh, and so only reads (and makes
+    the buffers of) the rasters around it::
+
+        coords = mesh2d.coordinates.dat.data_ro
+        bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "marine_digimap.tif"),
+             distances=(10000, 5000),
+             roi=coords, halo=1000)
+
+    halo grows the region by that distance all round, e.g. for points
+    that will be added later, or are just outside the partition. A rank
+    with no points (an empty roi) gets a stack of just a corner of the
+    base raster, so it can take part as the others do.
+
+    Creating buffers for large rasters can take a while. They can be kept
+    in a cache on disk and reused automatically whenever the same raster,
+    distance and region are used again::
+
+        bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "marine_digimap.tif"),
+             distances=(10000, 5000),
+             buffer_cache="/scratch/hrds_cache")
+
+    buffer_cache can be a directory, True (use the default directory, see
+    DiskCache) or a DiskCache object, which lets you set a size limit.
+
+    Similarly, array_cache keeps the decoded rasters on disk, to be memory
+    mapped, rather than decoded again, by later runs.
+
+    Models are often run many times on the same mesh. result_cache keeps
+    the values get_vals gives for each set of points, so the next run
+    loads them rather than interpolating again::
+
+        bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "marine_digimap.tif"),
+             distances=(10000, 5000),
+             result_cache=DiskCache("/scratch/hrds_results",
+                                    max_bytes=50*1024**3,
+                                    max_age=30*24*3600))
+
+    Results are found again only for exactly the same points, and are
+    not used if any raster changes. Those not used for longest are
+    removed once the cache is bigger than max_bytes, or older than
+    max_age seconds.
+
+    Buffers for each raster are independent, as is reading in each raster,
+    so both can be done at the same time on a pool of threads, using e.g.
+    workers=6. Start up then takes roughly as long as the slowest layer.
+
+    set_bands also builds a coarse index of which layers cover where, so
+    that most queries go straight to the one layer (or the base) that
+    gives their value, rather than checking every layer in turn. Its
+    resolution is set by index_size. The layers a point is in are found
+    with an R-tree, so stacks of hundreds of tiles are fine.
+
+    With many tiles, most queries (e.g. a mesh of part of the domain) only
+    need a few of them. Setting lazy_open=True only reads the header of
+    each tile (then closes it) when the stack is created, and opens and
+    reads the tile, and creates its buffer, the first time a query touches
+    it::
+
+        tiles = sorted(glob.glob("survey_tiles/*.tif"))
+        bathy = HRDS("gebco_uk.tif",
+             rasters=tiles,
+             distances=[500]*len(tiles),
+             lazy_open=True)
+
+    Survey data often come as many tiles of the same priority. A layer can
+    be a directory of tiles, a glob pattern, a list of tiles or a GDAL VRT
+    file, in place of a single raster::
+
+        bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "survey_tiles/"),
+             distances=(10000, 500))
+
+    The tiles are joined into one seamless raster (see build_mosaic), with
+    one buffer along the outside of the mosaic and any gaps, rather than
+    one around each tile. Mosaics are read lazily, so only the tiles that
+    queries touch are read.
+
+    Large stacks can be kept in 2-4 times less memory by storing the
+    rasters as 16 bit integers and the buffers as bytes, with quantize=True
+    (see QuantizedBand for the error this introduces).
+
+    Once built, a stack can be saved to a single file and loaded again in
+    milliseconds, without the original rasters or GDAL::
+
+        bathy.save("bathy.hrds")
+        bathy = HRDS.load("bathy.hrds")
+
+    Independent processes on the same machine (e.g. the members of an
+    ensemble) can share one copy of a stack::
+
+        bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "marine_digimap.tif"),
+             distances=(10000, 5000),
+             node_share=True)
+
+    The first process builds the stack and saves it to /dev/shm; the rest
+    memory map it from there (see hrds.node), and it is removed when the
+    last of them is finished with it. Only the first band of each raster
+    is used, and the stack is ready to use without set_bands.
+
+    A stack (and a RasterInterpolator) can be pickled, e.g. to send it to
+    worker processes; the rasters are opened again in each process when
+    first needed. share() moves the stack into shared memory first, so the
+    workers all use the one copy of it.
+
     It is possible to use HRDS as an interpolator for a single raster. Simply set-up
     the baseRaster only, e.g.
  
@@ -89,20 +256,64 @@ class HRDS():
 
     """
     def __init__(self, baseRaster, rasters=None, distances=None,
-                 buffers=None, minmax=None, saveBuffers=False):
+                 buffers=None, minmax=None, saveBuffers=False, lazy=False,
+                 roi=None, buffer_cache=None, workers=None, index_size=512,
+                 lazy_open=False, quantize=None, array_cache=None,
+                 node_share=None, halo=0.0, result_cache=None):
         """
         Set up our hrds object
 
         Args:
           baseRaster: the low res raster filename across whole domain.
           rasters: a list of filenames of the other rasters in priority order.
+            Each can also be a mosaic of tiles: a directory, glob pattern,
+            list of filenames or .vrt file (see build_mosaic).
           distances: the distance to create a buffer (in same units as
             corresponding raster) for each.
           buffers: a list of buffer filenames in the same order as rasters
             if created already. In this case, don't supply distances.
           minmax: list of minimum and maximum values to use
           saveBuffers: boolean to save buffers if needed
+          lazy: boolean to read the rasters in blocks as needed, rather
+            than loading them in full
+          roi: region of interest. A bounding box (xmin, ymin, xmax, ymax),
+            polygon or array of points. Only the rasters within its bounding
+            box are read. If there are no points, only a corner of the base
+            is read and the other rasters are left out.
+          buffer_cache: a directory, True or DiskCache object in which to
+            keep created buffers for reuse. Default is None (no cache).
+          workers: number of threads to create buffers and load rasters
+            on. Default is None (one at a time).
+          index_size: the number of cells along the longest side of the
+            coverage index built by set_bands (see CoverageIndex). None
+            turns the index off.
+          lazy_open: boolean to only read each raster, and create its
+            buffer, the first time a query touches it
+          quantize: keep the rasters as this integer type (e.g. np.int16,
+            or True for np.int16) and the buffers as np.uint8, to save
+            memory (see QuantizedBand). Not for use with lazy.
+          array_cache: a directory, True or DiskCache object in which to
+            keep the decoded rasters, so later runs can memory map them
+            (see RasterInterpolator). Default is None (no cache).
+          node_share: a directory, True (for /dev/shm/hrds) or DiskCache
+            object in which to share the stack with other processes on
+            this machine (see hrds.node). Default is None (don't share).
+          halo: the distance to grow the region of interest by
+          result_cache: a directory, True or DiskCache object in which to
+            keep the values get_vals gives, for the same points next time.
+            Default is None (no cache).
         """
+        self._node = None
+        stack_options = dict(rasters=rasters, distances=distances,
+                             buffers=buffers, minmax=minmax, roi=roi,
+                             buffer_cache=buffer_cache, workers=workers,
+                             index_size=index_size, quantize=quantize,
+                             array_cache=array_cache, halo=halo)
+        if node_share is not None:
+            self._attach(node.node_cache(node_share), baseRaster,
+                         stack_options)
+            self._use_result_cache(result_cache, baseRaster, stack_options)
+            return
 
         if rasters is None:
             # single raster only, check everything else is none
@@ -131,47 +342,126 @@ class HRDS():
                                     "You gave me: "+str(len(minmax))+" min/max" +
                                     "and I expected: "+str(len(rasters)+1))
 
+        self.bbox = None
+        if roi is not None:
+            self.bbox = _bounding_box(roi, halo)
+        # no points, e.g. an MPI rank that owns none of the mesh
+        empty_roi = roi is not None and self.bbox is None
+        if quantize is True:
+            quantize = np.int16
+        # buffers are between 0 and 1, so fit in a byte
+        buffer_quantize = {}
+        if quantize:
+            buffer_quantize = dict(quantize=np.uint8, quantize_limits=(0, 1))
+        array_cache = open_cache(array_cache)
         if minmax is None:
-            self.baseRaster = RasterInterpolator(baseRaster)
+            self.baseRaster = RasterInterpolator(baseRaster, lazy=lazy,
+                                                 bbox=self.bbox,
+                                                 quantize=quantize,
+                                                 array_cache=array_cache)
         else:
-            self.baseRaster = RasterInterpolator(baseRaster, minmax[0])
+            self.baseRaster = RasterInterpolator(baseRaster, minmax[0],
+                                                 lazy=lazy, bbox=self.bbox,
+                                                 quantize=quantize,
+                                                 array_cache=array_cache)
+        if empty_roi:
+            # the least of the base there is to read
+            llc = [float(c) for c in self.baseRaster.get_box()[0]]
+            self.bbox = llc + llc
+            self.baseRaster.bbox = self.bbox
         self.raster_stack = []
         if (rasters is not None):
-            for i, r in enumerate(rasters):
+            # layers made of many tiles are joined into one virtual raster,
+            # which is always read lazily so only the tiles used are opened
+            sources = []
+            tiles = []
+            for r in rasters:
+                if is_mosaic(r):
+                    vrt, t = build_mosaic(r)
+                    sources.append(vrt)
+                    tiles.append(t)
+                else:
+                    sources.append(r)
+                    tiles.append(None)
+            for i, r in enumerate(sources):
+                if tiles[i] is None:
+                    options = dict(lazy=lazy, quantize=quantize,
+                                   array_cache=array_cache)
+                else:
+                    options = dict(lazy=True)
                 if minmax is None:
-                    self.raster_stack.append(RasterInterpolator(r))
+                    self.raster_stack.append(RasterInterpolator(
+                        r, bbox=self.bbox, **options))
                 else:
-                    self.raster_stack.append(RasterInterpolator(r, minmax[i+1]))
+                    self.raster_stack.append(RasterInterpolator(
+                        r, minmax[i+1], bbox=self.bbox, **options))
+            if self.bbox is not None:
+                # drop any rasters that are outside our region
+                keep = [i for i, r in enumerate(self.raster_stack)
+                        if not empty_roi and r.overlaps(self.bbox)]
+                self.raster_stack = [self.raster_stack[i] for i in keep]
+                rasters = [rasters[i] for i in keep]
+                sources = [sources[i] for i in keep]
+                tiles = [tiles[i] for i in keep]
+                if distances is not None:
+                    distances = [distances[i] for i in keep]
+                if buffers is not None:
+                    buffers = [buffers[i] for i in keep]
+        buffer_cache = open_cache(buffer_cache)
         self.buffer_stack = []
+        self._pending = []
+        self.workers = workers
+        self.index_size = index_size
+        # how much get_vals(dedup=...) saved, the last time it was used
+        self.dedup_report = None
+        # whether share() has been called since set_bands
+        self._shared = False
+        self.index = None
+        self.lazy_open = lazy_open
+
         # the user is asking us to create the buffer files
         if buffers is None and rasters is not None:
-            # we create the files in a temp dir and if the user wants
-            # them afterwards we copy to a sensible name
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                for r, d in zip(rasters, distances):
-                    # create buffer file name, based on raster filename
-                    keep_buf_file = os.path.splitext(r)[0]+"_buffer.tif"
-                    temp_buf_file = os.path.join(tmpdirname,
-                                                 os.path.splitext(
-                                                     os.path.basename(r))[0] +
-                                                 "_buffer.tif")
-                    # create buffer
-                    rbuff = CreateBuffer(r, d)
-                    rbuff.make_buffer(temp_buf_file)
-                    # add to stack and store in memory
-                    self.buffer_stack.append(RasterInterpolator(temp_buf_file))
-                    # does the user also want the file saving?
-                    if saveBuffers:
-                        copyfile(temp_buf_file, keep_buf_file)
+            # each layer is independent, so can be built at the same time
+            layers = list(zip(rasters, self.raster_stack, distances,
+                              sources, tiles))
+            if buffer_cache:
+                make = partial(_cached_buffer, buffer_cache=buffer_cache,
+                               bbox=self.bbox, save=saveBuffers, lazy=lazy,
+                               **buffer_quantize)
+            else:
+                make = partial(_memory_buffer, bbox=self.bbox,
+                               save=saveBuffers, **buffer_quantize)
+            if lazy_open:
+                # made by open_layer when first needed
+                self._pending = [partial(make, layer) for layer in layers]
+                self.buffer_stack = [None] * len(layers)
+            else:
+                self.buffer_stack = _map(make, layers, workers)
 
         elif rasters is not None:
             # create buffer stack from filenames
             for r in buffers:
-                self.buffer_stack.append(RasterInterpolator(r))
+                self.buffer_stack.append(RasterInterpolator(
+                    r, lazy=lazy, bbox=self.bbox, **buffer_quantize))
 
         # reverse the arrays
         self.buffer_stack.reverse()
         self.raster_stack.reverse()
+        if len(self._pending) > 0:
+            self._pending.reverse()
+        else:
+            self._pending = [None] * len(self.raster_stack)
+        self.bands = [1] * len(self.raster_stack)
+        self.opened = [False] * len(self.raster_stack)
+        self._lock = threading.Lock()
+        # an index of where each layer is, to find those a point is in
+        self.tree = _layer_tree(self.raster_stack)
+        if lazy_open:
+            # only the headers were needed so far; open_layer opens the
+            # rasters again
+            for r in self.raster_stack:
+                r.close()
+        self._use_result_cache(result_cache, baseRaster, stack_options)
 
     def set_bands(self, bands=None):
         """
@@ -183,23 +473,151 @@ class HRDS():
                 (uses the first band in each raster). Default is None.
 
         """
+        if self._node is not None:
+            # ready to use already
+            if bands is not None and any(band != 1 for band in bands):
+                raise HRDSError("A stack shared with node_share only has "
+                                "the first band of each raster")
+            return
 
         if bands is None:
-            self.baseRaster.set_band()
+            layers = [(self.baseRaster, 1)]
             for r in self.raster_stack:
-                r.set_band()
+                layers.append((r, 1))
             for r in self.buffer_stack:
-                r.set_band()
+                layers.append((r, 1))
         else:
             counter = 1
-            self.baseRaster.bands(bands[0])
+            layers = [(self.baseRaster, bands[0])]
             for r in self.raster_stack:
-                r.set_band(bands[counter])
+                layers.append((r, bands[counter]))
                 counter += 1
             counter = 1
             for r in self.buffer_stack:
-                r.set_band(bands[counter])
+                layers.append((r, bands[counter]))
                 counter += 1
+        self.bands = [band for r, band in layers[1:len(self.raster_stack)+1]]
+        self._shared = False
+        if self.lazy_open:
+            # the rest are read by open_layer when first needed
+            layers = layers[:1]
+            self.opened = [False] * len(self.raster_stack)
+        else:
+            self.opened = [True] * len(self.raster_stack)
+        # each raster is read independently, so can be done at the same time
+        _map(lambda layer: layer[0].set_band(layer[1]), layers, self.workers)
+        # find which layers cover where, so queries can skip straight to them
+        self.index = None
+        if (self.index_size and len(self.raster_stack) > 0 and
+           not self.lazy_open):
+            self.index = CoverageIndex(self.raster_stack, self.buffer_stack,
+                                       self.index_size)
+
+    def open_layer(self, k):
+        """
+        Make sure a layer of the stack is ready to use. With lazy_open,
+        each raster is read, and its buffer created, the first time this
+        is called for it; otherwise it does nothing.
+
+        Args:
+            k: the position of the layer in raster_stack
+        """
+        if self.opened[k]:
+            return
+        with self._lock:
+            if self.opened[k]:
+                return
+            if self.buffer_stack[k] is None:
+                self.buffer_stack[k] = self._pending[k]()
+            self.raster_stack[k].set_band(self.bands[k])
+            self.buffer_stack[k].set_band(self.bands[k])
+            self.opened[k] = True
+
+    def _attach(self, cache, baseRaster, options):
+        """
+        Use the stack shared by another process on this machine, or build
+        and share it if there isn't one yet (see node_share).
+
+        Args:
+            cache: the DiskCache the stacks are kept in
+            baseRaster: as HRDS
+            options: the rest of the arguments to HRDS, except lazy and
+                lazy_open (the stack is memory mapped anyway)
+        """
+        key = make_key("stack", STORE_VERSION,
+                       *_stack_config(cache, baseRaster, options))
+
+        def build(filename):
+            stack = HRDS(baseRaster, **options)
+            stack.set_bands()
+            stack.save(filename)
+
+        shared = HRDS.load(node.attach(cache, key, build))
+        self.__dict__.update(shared.__dict__)
+        self._node = weakref.finalize(self, node.leave, cache, key)
+
+    def _use_result_cache(self, result_cache, baseRaster, options):
+        """
+        Keep the values get_vals gives in a cache (see result_cache).
+
+        Args:
+            result_cache: as HRDS
+            baseRaster: as HRDS
+            options: the rest of the arguments to HRDS
+        """
+        self.result_cache = open_cache(result_cache)
+        self._config = None
+        if self.result_cache:
+            self._config = _stack_config(self.result_cache, baseRaster,
+                                         options)
+
+    def __getstate__(self):
+        # the lock can't be pickled, and is per process anyway, as is
+        # the use of a shared stack
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_node"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def share(self):
+        """
+        Move the stack into shared memory, so that it can be sent to a pool
+        of worker processes and still be in memory only once::
+
+            bathy.set_bands()
+            bathy.share()
+            with ProcessPoolExecutor(8) as pool:
+                depths = list(pool.map(partial(sample, bathy), meshes))
+
+        Pickling the stack (as the pool does) then sends handles to the
+        shared memory, rather than copies of the rasters; see
+        RasterInterpolator.share. Rasters that are memory mapped (see
+        array_cache and HRDS.load) are shared already, and lazy ones are
+        read by each process. With lazy_open, only the layers opened so
+        far are shared.
+
+        The shared memory is freed when this stack is garbage collected,
+        so it must outlive the workers.
+
+        Returns:
+            this HRDS object
+        """
+        if self.baseRaster.interpolator is None:
+            raise HRDSError("Should call set_bands() before share()")
+        self.baseRaster.share()
+        for k in range(len(self.raster_stack)):
+            if self.opened[k]:
+                self.raster_stack[k].share()
+                self.buffer_stack[k].share()
+        if self.index is not None:
+            self.index.layer = share_array(self.index.layer)
+            self.index.pure = share_array(self.index.pure)
+        self._shared = True
+        return self
 
     def get_val(self, point):
         """
@@ -217,28 +635,730 @@ class HRDS():
             RasterInterpolatorError: Generic error interpolating
                 data at that point
         """
-        # determine if we're in any of the rasters in the list,
-        # starting from the last one
-        for i, r, b in zip(range(0, len(self.raster_stack)+1),
-                           self.raster_stack,
-                           self.buffer_stack):
-            if r.point_in(point):
-                # if so, check the buffer value
-                if b.get_val(point) == 1.0:
-                    return r.get_val(point)
-                else:
-                    for rr in self.raster_stack[i+1:]:
-                        # if not, find the next raster we're in, inc. the base
-                        if (rr.point_in(point) and
-                           not self.buffer_stack[i+1].get_val(point) == 0):
-                            val = r.get_val(point)*b.get_val(point) + \
-                                  rr.get_val(point)*(1-b.get_val(point))
-                            return val
-                    # if we get here, there is no other layer,
-                    # so use base raster
-                    val = r.get_val(point)*b.get_val(point) + \
-                        self.baseRaster.get_val(point)*(1-b.get_val(point))
-                    return val
-
-        # we're not in the raster stack, so return value from base
-        return self.baseRaster.get_val(point)
+        if self.index is not None:
+            layer, pure = self.index.lookup(point)
+            if layer < 0:
+                return self.baseRaster.get_val(point)
+            if pure:
+                return self.raster_stack[layer].get_val(point)
+        # determine which of the rasters in the list we're in, in
+        # priority order
+        layers = self.tree.query(point) if self.tree is not None else []
+        if len(layers) == 0:
+            # we're not in the raster stack, so return value from base
+            return self.baseRaster.get_val(point)
+        i = layers[0]
+        self.open_layer(i)
+        r = self.raster_stack[i]
+        b = self.buffer_stack[i]
+        # check the buffer value
+        if b.get_val(point) == 1.0:
+            return r.get_val(point)
+        for k in layers[1:]:
+            # if not, find the next raster we're in, inc. the base
+            self.open_layer(k)
+            if not self.buffer_stack[k].get_val(point) == 0:
+                val = r.get_val(point)*b.get_val(point) + \
+                      self.raster_stack[k].get_val(point)*(1-b.get_val(point))
+                return val
+        # if we get here, there is no other layer,
+        # so use base raster
+        val = r.get_val(point)*b.get_val(point) + \
+            self.baseRaster.get_val(point)*(1-b.get_val(point))
+        return val
+
+    def get_vals(self, points, fill=None, workers=None,
+                 chunk_size=CHUNK_SIZE, processes=False, order=None,
+                 dedup=None):
+        """
+        Performs bilinear interpolation of your raster stack
+        to give values at many points at once. The results are identical
+        to calling get_val on each point, but the points are grouped by
+        the layer they need and each raster and buffer is evaluated once
+        per group.
+
+        Very many points can be shared out between workers::
+
+            depths = bathy.get_vals(mesh_nodes, workers=8)
+
+        The points are split into chunks of nearby points, so each chunk
+        only needs a few layers (and, for lazy rasters, blocks), which are
+        evaluated on a pool of threads, or of processes if processes is
+        True. Processes are not limited by Python's global interpreter
+        lock, but the stack must be moved into shared memory first (see
+        share), and each process opens the rasters itself::
+
+            bathy.share()
+            depths = bathy.get_vals(mesh_nodes, workers=8, processes=True)
+
+        A new pool of processes is started for each call, which takes a
+        second or so, so this is for very many points at a time. Either
+        way, the values are the same as with one worker, and in the order
+        of the points.
+
+        Points from a mesh are usually scattered over the rasters in the
+        order they come in, so each group of them jumps about its raster.
+        With order="hilbert" (or "morton") they are evaluated in the order
+        of a space-filling curve over the base raster (see curve_order),
+        so nearby points are evaluated together and each part of the
+        rasters is read about once, which is kinder to the CPU's caches
+        and, for lazy rasters, to the block cache. The values are still
+        given back in the order of the points.
+
+        The nodes of discontinuous (or vector) function spaces repeat the
+        same coordinates many times. With dedup=True each distinct point
+        is only evaluated once (see unique_points); with a number, points
+        within that distance (on a grid) of each other are treated as the
+        same and given the value of the first of them. How many points
+        there were, and how many were evaluated, is then kept in
+        dedup_report::
+
+            depths = bathy.get_vals(dg_nodes, dedup=True)
+            bathy.dedup_report  # {'points': 600, 'unique': 100,
+                                #  'ratio': 6.0}
+
+        With a result_cache (see HRDS), the values are saved, under a hash
+        of the points, the stack (its files and their modification times,
+        distances, minmax and bands) and fill, and a later call with the
+        same points, e.g. in the next run of a model on the same mesh,
+        memory maps them rather than interpolating again. The values are
+        then a copy-on-write numpy.memmap, which can be changed without
+        changing the cache, and dedup_report is None.
+
+        Args:
+            points: an (N, 2) array-like of x,y coordinates
+            fill: value to give points outside the base raster, rather
+                than raising a CoordinateError. Points outside the base
+                but inside a layer get that layer's value, without blending
+                (there is nothing to blend it with). Default is None.
+            workers: the number of threads (or processes) to share the
+                points between. Default is None (all in this thread).
+            chunk_size: the number of points in each chunk given to a
+                worker
+            processes: use a pool of processes, rather than threads
+            order: evaluate the points along this space-filling curve,
+                "hilbert" or "morton". Default is None (as they come,
+                or in chunks of nearby points with workers).
+            dedup: evaluate each distinct point once: True for exactly
+                the same points, or the tolerance for points to be the
+                same. Default is None (evaluate every point).
+
+        Returns:
+            A length N numpy array of values of the raster stack
+
+        Raises:
+            CoordinateError: A point is outside the rasters
+            RasterInterpolatorError: Generic error interpolating
+                data at that point
+            HRDSError: processes is True, but share() hasn't been called
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if (processes and workers is not None and workers > 1 and
+                not self._shared):
+            raise HRDSError("Should call share() before get_vals() with "
+                            "processes")
+        evaluate = partial(self._evaluate, fill=fill, workers=workers,
+                           chunk_size=chunk_size, processes=processes,
+                           order=order, dedup=dedup)
+        if self._config is None:
+            return evaluate(points)
+        points = np.ascontiguousarray(points)
+        key = make_key("vals", RESULT_VERSION, self._config,
+                       self.baseRaster.band, self.bands,
+                       hashlib.sha256(points).hexdigest(),
+                       len(points), None if fill is None else float(fill),
+                       # an exact dedup gives the same values as none
+                       None if (dedup is None or dedup is False or
+                                dedup is True) else float(dedup))
+        filename = self.result_cache.get(key, ".npy")
+        if filename is not None:
+            try:
+                vals = np.load(filename, mmap_mode="c")
+            except OSError:
+                # evicted by another process in the meantime
+                pass
+            else:
+                # nothing was deduplicated this time
+                self.dedup_report = None
+                return vals
+        vals = evaluate(points)
+        self.result_cache.put(key, ".npy", lambda f: np.save(f, vals))
+        return vals
+
+    def _evaluate(self, points, fill=None, workers=None,
+                  chunk_size=CHUNK_SIZE, processes=False, order=None,
+                  dedup=None):
+        """
+        get_vals, without the result cache.
+
+        Args:
+            points: an (N, 2) numpy array of x,y coordinates
+            the rest: as get_vals
+
+        Returns:
+            A length N numpy array of values of the raster stack
+        """
+        if dedup is not None and dedup is not False:
+            index, inverse = unique_points(
+                points, None if dedup is True else dedup)
+            self.dedup_report = {"points": len(points),
+                                 "unique": len(index),
+                                 "ratio": len(points) / max(len(index), 1)}
+            return self._evaluate(points[index], fill, workers, chunk_size,
+                                  processes, order)[inverse]
+        parallel = (workers is not None and workers > 1 and
+                    len(points) > chunk_size)
+        if order is None and not parallel:
+            return self._sample(points, fill)
+        if order is not None:
+            box = np.concatenate(self.baseRaster.get_box())
+            order = curve_order(points, box, order)
+        else:
+            order = _coherent_order(points, chunk_size)
+        vals = np.empty(len(points))
+        if not parallel:
+            vals[order] = self._sample(points[order], fill)
+            return vals
+        chunks = [order[s:s + chunk_size]
+                  for s in range(0, len(points), chunk_size)]
+        if processes:
+            with ProcessPoolExecutor(workers, initializer=_set_worker_stack,
+                                     initargs=(self,)) as pool:
+                results = pool.map(_worker_sample,
+                                   [points[c] for c in chunks],
+                                   [fill] * len(chunks))
+                for c, result in zip(chunks, results):
+                    vals[c] = result
+        else:
+            def sample(c):
+                vals[c] = self._sample(points[c], fill)
+
+            with ThreadPoolExecutor(workers) as pool:
+                # list() raises any error from the workers
+                list(pool.map(sample, chunks))
+        return vals
+
+    def _sample(self, points, fill=None):
+        """
+        get_vals for one set of points, in this thread.
+
+        Args:
+            points: an (N, 2) numpy array of x,y coordinates
+            fill: value to give points outside the base raster
+
+        Returns:
+            A length N numpy array of values of the raster stack
+        """
+        vals = np.empty(len(points))
+        todo = np.ones(len(points), dtype=bool)
+        if self.index is not None:
+            # points that only one layer (or the base) can give a value to
+            layer, pure = self.index.lookup_many(points)
+            for k in np.unique(layer[pure]):
+                idx = np.flatnonzero(pure & (layer == k))
+                vals[idx] = _get_vals(self.raster_stack[k], points[idx])
+            idx = np.flatnonzero(layer < 0)
+            if len(idx) > 0:
+                vals[idx] = _get_vals(self.baseRaster, points[idx], fill)
+            todo = np.logical_not(pure | (layer < 0))
+        idx = np.flatnonzero(todo)
+        if len(idx) > 0:
+            vals[idx] = self._walk_stack(points[idx], fill)
+        return vals
+
+    def _walk_stack(self, points, fill=None):
+        """
+        Batch version of the walk through the raster stack in get_val,
+        without the coverage index. The layers each point is in come
+        from the R-tree, sorted by point then priority, so each point
+        only visits the layers it is in.
+
+        Args:
+            points: an (N, 2) numpy array of x,y coordinates
+            fill: value to give points outside the base raster and every
+                layer. Points outside the base in the buffer zone of a
+                layer get that layer's value alone.
+
+        Returns:
+            A length N numpy array of values of the raster stack
+        """
+        vals = np.empty(len(points))
+        if self.tree is not None:
+            pts, layers = self.tree.query_many(points)
+        else:
+            pts = layers = np.zeros(0, dtype=np.intp)
+        # where each point's layers start and end
+        first = np.flatnonzero(np.diff(pts, prepend=-1))
+        last = np.append(first[1:], len(pts))
+        in_stack = pts[first]
+        top = layers[first]
+        # we're not in the raster stack, so use the base
+        base = np.ones(len(points), dtype=bool)
+        base[in_stack] = False
+        idx = np.flatnonzero(base)
+        if len(idx) > 0:
+            vals[idx] = _get_vals(self.baseRaster, points[idx], fill)
+
+        bv = np.empty(len(points))
+        for i in np.unique(top):
+            # everything whose highest priority layer is this one
+            self.open_layer(i)
+            idx = in_stack[top == i]
+            bv[idx] = _get_vals(self.buffer_stack[i], points[idx])
+            vals[idx] = _get_vals(self.raster_stack[i], points[idx])
+
+        # blend those in the buffer zone with the next raster
+        # we're in, inc. the base
+        blend = np.flatnonzero(bv[in_stack] != 1.0)
+        if len(blend) == 0:
+            return vals
+        idx = in_stack[blend]
+        other = np.empty(len(blend))
+        found = np.zeros(len(blend), dtype=bool)
+        # each point's next layer
+        nxt = first[blend] + 1
+        while True:
+            left = np.flatnonzero(np.logical_not(found) & (nxt < last[blend]))
+            if len(left) == 0:
+                break
+            ks = layers[nxt[left]]
+            for k in np.unique(ks):
+                self.open_layer(k)
+                cand = left[ks == k]
+                p = points[idx[cand]]
+                cand = cand[_get_vals(self.buffer_stack[k], p) != 0]
+                other[cand] = _get_vals(self.raster_stack[k],
+                                        points[idx[cand]])
+                found[cand] = True
+            nxt[left] += 1
+        bb = bv[idx]
+        cand = np.flatnonzero(np.logical_not(found))
+        if len(cand) > 0:
+            p = points[idx[cand]]
+            other[cand], outside = self.baseRaster.get_vals(p)
+            if outside.any():
+                if fill is None:
+                    # let the scalar version raise for the first one
+                    self.baseRaster.get_val(p[np.argmax(outside)])
+                # outside the base, so there is nothing to blend with;
+                # use the layer's value alone, rather than blending in fill
+                bb[cand[outside]] = 1.0
+                other[cand[outside]] = 0.0
+        vals[idx] = vals[idx]*bb + other*(1-bb)
+        return vals
+
+    def save(self, path):
+        """
+        Save the stack, ready to use, to a single file (see hrds.store)::
+
+            bathy.save("bathy.hrds")
+
+        Everything that building the stack works out is kept: the extent,
+        cell size, minmax and values of each raster and buffer, in priority
+        order, and the coverage index. Quantized rasters stay quantized.
+        See HRDS.load.
+
+        set_bands must have been called. With lazy_open, every layer is
+        opened first; lazy rasters are read a strip at a time.
+
+        Args:
+            path: the file to write
+        """
+        if self.baseRaster.interpolator is None:
+            raise HRDSError("Should call set_bands() before save()")
+        for k in range(len(self.raster_stack)):
+            self.open_layer(k)
+        index = self.index
+        if (index is None and self.index_size and
+                len(self.raster_stack) > 0):
+            index = CoverageIndex(self.raster_stack, self.buffer_stack,
+                                  self.index_size)
+        arrays = {}
+
+        def describe(name, r):
+            val = r.val
+            quantized = None
+            if isinstance(val, QuantizedBand):
+                quantized = {"vmin": val.vmin, "span": val.span,
+                             "low": int(val.low), "steps": int(val.steps),
+                             "nodata_code": (None if val.nodata_code is None
+                                             else int(val.nodata_code))}
+                val = val.codes
+            arrays[name] = val
+            return {"array": name,
+                    "extent": [[float(c) for c in corner]
+                               for corner in r.extent],
+                    "dx": [float(d) for d in r.dx],
+                    "nodata": None if r.nodata is None else float(r.nodata),
+                    "minmax": (None if r.minmax is None else
+                               [None if m is None else float(m)
+                                for m in r.minmax]),
+                    "projection": r.ds.GetProjection(),
+                    "quantized": quantized}
+
+        header = {"version": STORE_VERSION,
+                  "bbox": (None if self.bbox is None else
+                           [float(b) for b in self.bbox]),
+                  "index_size": self.index_size,
+                  "base": describe("base", self.baseRaster),
+                  "rasters": [describe("raster_" + str(k), r)
+                              for k, r in enumerate(self.raster_stack)],
+                  "buffers": [describe("buffer_" + str(k), b)
+                              for k, b in enumerate(self.buffer_stack)],
+                  "index": None}
+        if index is not None:
+            header["index"] = {"origin": [float(o) for o in index.origin],
+                               "cell": float(index.cell)}
+            arrays["index_layer"] = index.layer
+            arrays["index_pure"] = index.pure
+        write_store(path, header, arrays)
+
+    @classmethod
+    def load(cls, path, result_cache=None):
+        """
+        Load a stack saved by HRDS.save, ready to use (there is no need to
+        call set_bands)::
+
+            bathy = HRDS.load("bathy.hrds")
+            bathy.get_vals(points)
+
+        Neither GDAL nor the original rasters are needed. The arrays are
+        memory mapped, so this only reads the description of the stack;
+        the values are read from disk as queries touch them, and shared
+        between processes on the same machine.
+
+        Args:
+            path: the file saved by HRDS.save
+            result_cache: as HRDS
+
+        Returns:
+            an HRDS object
+
+        Raises:
+            HRDSError: The file is from a different version of HRDS
+        """
+        header, arrays = read_store(path)
+        if header.get("version") != STORE_VERSION:
+            raise HRDSError(str(path) + " was saved by a different "
+                            "version of HRDS. Please save it again.")
+
+        def layer(meta):
+            val = arrays[meta["array"]]
+            if meta["quantized"] is not None:
+                val = QuantizedBand.from_codes(val, nodata=meta["nodata"],
+                                               **meta["quantized"])
+            return RasterInterpolator.from_array(val, meta["extent"],
+                                                 meta["dx"], meta["nodata"],
+                                                 meta["minmax"],
+                                                 meta["projection"])
+
+        bathy = cls.__new__(cls)
+        bathy._node = None
+        bathy.bbox = header["bbox"]
+        bathy.baseRaster = layer(header["base"])
+        bathy.raster_stack = [layer(meta) for meta in header["rasters"]]
+        bathy.buffer_stack = [layer(meta) for meta in header["buffers"]]
+        n = len(bathy.raster_stack)
+        bathy._pending = [None] * n
+        bathy.workers = None
+        bathy.index_size = header["index_size"]
+        bathy.dedup_report = None
+        bathy._shared = False
+        bathy.lazy_open = False
+        bathy.bands = [1] * n
+        bathy.opened = [True] * n
+        bathy._lock = threading.Lock()
+        bathy.tree = _layer_tree(bathy.raster_stack)
+        bathy.index = None
+        if header["index"] is not None:
+            bathy.index = CoverageIndex.from_arrays(
+                arrays["index_layer"], arrays["index_pure"],
+                header["index"]["origin"], header["index"]["cell"])
+        bathy.result_cache = open_cache(result_cache)
+        bathy._config = None
+        if bathy.result_cache:
+            bathy._config = [bathy.result_cache.signature(path)]
+        return bathy
+
+    def bake(self, extent, dx, output_file, block_size=256, nodata=-9999.0):
+        """
+        Evaluate the whole raster stack on a regular grid and save it as
+        a single raster. Loading this with RasterInterpolator then gives
+        one bilinear lookup per point, rather than a walk through the
+        stack, for repeated use of the same stack::
+
+            bathy.bake([820000, 5840000, 845000, 5850000], 50.0,
+                       "baked.tif")
+            baked = RasterInterpolator("baked.tif")
+            baked.set_band()
+
+        Note that the baked raster is a resampling of the stack, so
+        values will differ slightly from get_val unless dx is small.
+
+        The grid has an extra cell all round extent, so the baked raster
+        can be interpolated anywhere in extent (e.g. at the boundary nodes
+        of a mesh whose bounding box is extent), not just up to half a
+        cell from its edges.
+
+        The grid is evaluated, and written out, one block at a time so
+        it is never all in memory.
+
+        Args:
+            extent: the region to cover (xmin, ymin, xmax, ymax)
+            dx: resolution of the grid, a number or a length 2 list
+            output_file: where to save the (tiled GeoTIFF) raster
+            block_size: the size (in cells) of the blocks evaluated and
+                written at a time. Must be a multiple of 16.
+            nodata: the value to use outside the base raster
+
+        Raises:
+            HRDSError: GDAL, which writes the raster, isn't installed
+        """
+        if gdal is None:
+            raise HRDSError("GDAL is needed to bake a stack to " +
+                            str(output_file))
+        dx = np.broadcast_to(np.asarray(dx, dtype=np.float64), (2,))
+        # the cells covering extent, and one more on each side
+        nx = int(np.ceil((extent[2] - extent[0]) / dx[0])) + 2
+        ny = int(np.ceil((extent[3] - extent[1]) / dx[1])) + 2
+        x_min = extent[0] - dx[0]
+        y_max = extent[1] + (ny - 1) * dx[1]
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(output_file, nx, ny, 1, gdal.GDT_Float32,
+                                options=['TILED=YES',
+                                         'BLOCKXSIZE=' + str(block_size),
+                                         'BLOCKYSIZE=' + str(block_size),
+                                         'BIGTIFF=IF_SAFER'])
+        dataset.SetGeoTransform((x_min, dx[0], 0, y_max, 0, -dx[1]))
+        dataset.SetProjection(self.baseRaster.ds.GetProjection())
+        band = dataset.GetRasterBand(1)
+        band.SetNoDataValue(nodata)
+        for i in range(0, ny, block_size):
+            # cell centres, with rows from the top as in the file
+            y = y_max - (np.arange(i, min(i + block_size, ny)) + 0.5) * dx[1]
+            for j in range(0, nx, block_size):
+                x = x_min + (np.arange(j, min(j + block_size, nx)) +
+                             0.5) * dx[0]
+                xx, yy = np.meshgrid(x, y)
+                vals = self._evaluate(np.column_stack((xx.ravel(),
+                                                       yy.ravel())),
+                                      fill=nodata)
+                band.WriteArray(vals.reshape(xx.shape), j, i)
+        dataset.FlushCache()
+        dataset = None
+
+
+def _map(func, items, workers):
+    """
+    Apply a function to each item, on a pool of threads if workers > 1.
+
+    Returns:
+        a list of the results, in the same order as the items
+    """
+    if workers is None or workers < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(func, items))
+
+
+def _create_buffer(source, distance, bbox, tiles):
+    """
+    Set up the buffer of a layer. Mosaics are read a tile of the buffer
+    at a time, so only the part of the mosaic needed is in memory.
+    """
+    if tiles is None:
+        return CreateBuffer(source, distance, bbox=bbox)
+    return CreateBuffer(source, distance, bbox=bbox, tile_size=MOSAIC_TILE)
+
+
+def _cached_buffer(layer, buffer_cache, bbox, save, lazy, **options):
+    """
+    The buffer of a layer from the cache, making it if needed.
+    """
+    r, ri, d, src, t = layer
+    nodata = ri.ds.GetRasterBand(1).GetNoDataValue()
+    if t is None:
+        signature = buffer_cache.signature(r)
+    else:
+        signature = [buffer_cache.signature(f) for f in t]
+    key = make_key("buffer", signature, 1, d, None, nodata, bbox)
+    buf_file = buffer_cache.get(key, ".tif")
+    if buf_file is None:
+        rbuff = _create_buffer(src, d, bbox, t)
+        buf_file = buffer_cache.put(key, ".tif", rbuff.make_buffer)
+    if save:
+        copyfile(buf_file, _buffer_file(r, t))
+    return RasterInterpolator(buf_file, lazy=lazy, **options)
+
+
+def _memory_buffer(layer, bbox, save, **options):
+    """
+    The buffer of a layer, made in memory and only written out if the
+    user wants it afterwards.
+    """
+    r, ri, d, src, t = layer
+    rbuff = _create_buffer(src, d, bbox, t)
+    buf = rbuff.make_buffer()
+    # does the user also want the file saving?
+    if save:
+        # create buffer file name, based on raster filename
+        keep_buf_file = _buffer_file(r, t)
+        saved = gdal.GetDriverByName('GTiff').CreateCopy(keep_buf_file, buf)
+        saved.FlushCache()
+        saved = None
+    # read the buffer now, and let go of the dataset it was made in
+    rci = RasterInterpolator(buf, **options)
+    rci.set_band()
+    rci.keep_array()
+    return rci
+
+
+def _signature(cache, raster):
+    """
+    Something that changes if a raster, or the tiles of a mosaic, change.
+    """
+    if is_mosaic(raster):
+        return [cache.signature(t) for t in find_tiles(raster)]
+    if not isinstance(raster, str):
+        raise HRDSError("Only rasters in files can be used with "
+                        "node_share or result_cache, as there is no way "
+                        "to tell if an open dataset has changed")
+    return cache.signature(raster)
+
+
+def _stack_config(cache, baseRaster, options):
+    """
+    Everything that changes the values of a stack: the files (and their
+    modification times), distances, buffers, minmax, region of interest,
+    quantization and index.
+
+    Args:
+        cache: the DiskCache whose signature identifies the files
+        baseRaster: as HRDS
+        options: the rest of the arguments to HRDS
+
+    Returns:
+        a list, for make_key
+    """
+    rasters = options["rasters"]
+    buffers = options["buffers"]
+    quantize = options["quantize"]
+    if quantize is True:
+        quantize = np.int16
+    bbox = None
+    if options["roi"] is not None:
+        bbox = _bounding_box(options["roi"], options["halo"])
+        if bbox is None:
+            # not the same as no region of interest
+            bbox = "empty"
+    return [_signature(cache, baseRaster),
+            None if rasters is None else
+            [_signature(cache, r) for r in rasters],
+            options["distances"],
+            None if buffers is None else
+            [_signature(cache, b) for b in buffers],
+            options["minmax"],
+            bbox,
+            None if not quantize else np.dtype(quantize).str,
+            options["index_size"]]
+
+
+def _buffer_file(raster, tiles):
+    """
+    Where to save the buffer of a layer: next to the raster, or next to
+    the directory of tiles of a mosaic.
+    """
+    if tiles is not None:
+        if not isinstance(raster, str):
+            raster = os.path.dirname(tiles[0])
+        elif glob.has_magic(raster):
+            raster = os.path.dirname(raster)
+        raster = raster.rstrip(os.sep) or "mosaic"
+    return os.path.splitext(raster)[0]+"_buffer.tif"
+
+
+def _coherent_order(points, chunk_size):
+    """
+    An order of the points in which each run of chunk_size points is close
+    together. As for the leaves of an RTree, the points are sorted into
+    vertical slices by x and each slice is sorted by y, so each run covers
+    a small, roughly square, area.
+    """
+    chunks = int(np.ceil(len(points) / chunk_size))
+    slices = max(int(np.ceil(np.sqrt(chunks))), 1)
+    per_slice = max(int(np.ceil(chunks / slices)), 1) * chunk_size
+    order = np.argsort(points[:, 0], kind='stable')
+    for s in range(0, len(points), per_slice):
+        part = order[s:s + per_slice]
+        order[s:s + per_slice] = part[np.argsort(points[part, 1],
+                                                 kind='stable')]
+    return order
+
+
+# the stack each worker process of get_vals samples
+_worker_stack = None
+
+
+def _set_worker_stack(stack):
+    global _worker_stack
+    _worker_stack = stack
+
+
+def _worker_sample(points, fill):
+    return _worker_stack._sample(points, fill)
+
+
+def _layer_tree(raster_stack):
+    """
+    An index of where each layer is, to find those a point is in.
+    """
+    if len(raster_stack) == 0:
+        return None
+    return RTree([np.concatenate(r.get_box()) for r in raster_stack])
+
+
+def _bounding_box(roi, halo=0.0):
+    """
+    Get the bounding box of a region of interest.
+
+    Args:
+        roi: a bounding box (xmin, ymin, xmax, ymax), an (N, 2) array-like
+            of x,y vertices or points, or anything with a shapely-like
+            `bounds` attribute.
+        halo: the distance to grow the box by on each side
+
+    Returns:
+        [xmin, ymin, xmax, ymax], or None if roi is an empty array of
+        points
+    """
+    if hasattr(roi, "bounds"):
+        roi = roi.bounds
+    roi = np.asarray(roi, dtype=np.float64)
+    if roi.size == 0 and (roi.ndim == 1 or
+                          (roi.ndim == 2 and roi.shape[1] == 2)):
+        return None
+    grow = np.array([-halo, -halo, halo, halo])
+    if roi.ndim == 1 and len(roi) == 4:
+        return [float(v) for v in roi + grow]
+    if roi.ndim == 2 and roi.shape[1] == 2 and len(roi) > 0:
+        return [float(v) for v in np.concatenate((np.amin(roi, axis=0),
+                                                  np.amax(roi, axis=0))) +
+                grow]
+    raise HRDSError("The region of interest should be a bounding box "
+                    "(xmin, ymin, xmax, ymax) or a list of x,y vertices")
+
+
+def _get_vals(raster, points, fill=None):
+    """
+    Batch interpolate a single raster, raising the same error as get_val
+    would if any of the points are out of range, unless there is a value
+    to fill them with.
+    """
+    vals, outside = raster.get_vals(points)
+    if outside.any():
+        if fill is not None:
+            vals[outside] = fill
+        else:
+            # let the scalar version raise for the first offending point
+            raster.get_val(points[np.argmax(outside)])
+    return vals
@@ -0,0 +1,136 @@
+try:
+    from osgeo import gdal
+except ImportError:
+    # see raster.py
+    gdal = None
+from .raster import RasterInterpolatorError
+import glob
+import hashlib
+import os
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+"""
+This module joins many raster tiles of the same priority into a single
+seamless raster (a GDAL VRT), so they can be used as one layer of an HRDS
+stack.
+"""
+
+# used for gaps between tiles if the tiles have no no data value
+MOSAIC_NODATA = -9999.0
+
+
+def is_mosaic(source):
+    """
+    Is a raster layer made of many tiles?
+
+    Args:
+        source: a raster filename, directory, glob pattern, .vrt file or
+            list of filenames
+
+    Returns:
+        Boolean. True if the source needs build_mosaic.
+    """
+    if isinstance(source, (list, tuple)):
+        return True
+    if not isinstance(source, str):
+        return False
+    return (os.path.isdir(source) or glob.has_magic(source) or
+            source.lower().endswith(".vrt"))
+
+
+def find_tiles(source):
+    """
+    The tiles that make up a mosaic.
+
+    Args:
+        source: a directory (all the .tif and .tiff files in it are used),
+            a glob pattern, a list of filenames or a .vrt file
+
+    Returns:
+        A sorted list of filenames
+
+    Raises:
+        RasterInterpolatorError: There are no tiles
+    """
+    if isinstance(source, (list, tuple)):
+        tiles = list(source)
+    elif source.lower().endswith(".vrt"):
+        ds = gdal.Open(source)
+        if ds is None:
+            raise RasterInterpolatorError("Could not open " + source)
+        # the first file is the VRT itself
+        tiles = ds.GetFileList()[1:]
+    elif os.path.isdir(source):
+        tiles = (glob.glob(os.path.join(source, "*.tif")) +
+                 glob.glob(os.path.join(source, "*.tiff")))
+    else:
+        tiles = glob.glob(source)
+    if len(tiles) == 0:
+        raise RasterInterpolatorError("No raster tiles found in " +
+                                      str(source))
+    return sorted(tiles)
+
+
+def build_mosaic(source):
+    """
+    Join raster tiles into a single virtual raster::
+
+        vrt, tiles = build_mosaic("survey_tiles/")
+        rci = RasterInterpolator(vrt, lazy=True)
+
+    The tiles must have the same resolution and projection. Interpolation
+    across the joins between them is then seamless, and a buffer created
+    from the mosaic only follows its outer edge and any gaps or no data.
+    Gaps are filled with the tiles' no data value, or MOSAIC_NODATA if
+    they do not have one.
+
+    The VRT is kept in GDAL's in-memory filesystem. GDAL only opens a tile
+    when a read touches it, so with lazy=True only the tiles that queries
+    need are ever read. An existing .vrt file is used as is.
+
+    Args:
+        source: a directory (all the .tif and .tiff files in it are used),
+            a glob pattern, a list of filenames or a .vrt file
+
+    Returns:
+        A tuple of the VRT filename and the list of tiles in it
+
+    Raises:
+        RasterInterpolatorError: There are no tiles, or they could not be
+            joined
+    """
+    tiles = find_tiles(source)
+    if isinstance(source, str) and source.lower().endswith(".vrt"):
+        return source, tiles
+    key = hashlib.sha256(repr([os.path.abspath(t) for t in tiles])
+                         .encode("utf-8")).hexdigest()
+    vrt_file = "/vsimem/hrds_mosaic_" + key + ".vrt"
+    first = gdal.Open(tiles[0])
+    if first is None:
+        raise RasterInterpolatorError("Could not open " + tiles[0])
+    options = {}
+    if first.GetRasterBand(1).GetNoDataValue() is None:
+        options["VRTNodata"] = MOSAIC_NODATA
+    vrt = gdal.BuildVRT(vrt_file, tiles,
+                        options=gdal.BuildVRTOptions(**options))
+    if vrt is None:
+        raise RasterInterpolatorError("Could not join the tiles in " +
+                                      str(source))
+    # closing the VRT writes it out
+    vrt.FlushCache()
+    vrt = None
+    return vrt_file, tiles
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from .cache import DiskCache, _remove
+import os
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:
+    # not on Windows, where shared stacks are never removed
+    fcntl = None
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+"""
+This module shares raster stacks between the independent processes on a
+node (see the node_share option of HRDS). The first process to need a
+stack builds it and saves it (see HRDS.save) to a directory in memory;
+the others memory map that file, so there is one copy of the stack in
+memory however many processes use it.
+
+Each stack has two lock files next to it. <key>.build is held by a
+process while it builds, looks for, or removes the stack, so only one
+process builds it and the others wait for it. <key>.users is held (as a
+shared lock) by each process using the stack. When a process finishes
+with it and no other process holds that lock, the stack is removed. The
+operating system drops the locks of a process that dies, so a crash does
+not leave the stack in use forever, although then it is only removed
+when the next user of it finishes. The lock files are removed with the
+stack.
+
+Stacks are only removed this way, never to keep the directory within a
+size or age limit, as they may be in use (see node_cache).
+"""
+
+# processes using each stack, in this process: (directory, key) to
+# [users file, number of HRDS objects, pid]
+_users = {}
+_lock = threading.Lock()
+
+
+def node_cache(directory=None):
+    """
+    The directory shared stacks are kept in.
+
+    Args:
+        directory: a directory, True (the default) or a DiskCache. The
+            default is /dev/shm/hrds, so the stacks are in memory, or a
+            directory in the temporary directory if there is no /dev/shm.
+            The max_bytes and max_age of a DiskCache are not used, as
+            they would remove stacks still in use by other processes.
+
+    Returns:
+        a DiskCache, without size or age limits
+    """
+    if isinstance(directory, DiskCache):
+        return DiskCache(directory.directory,
+                         hash_content=directory.hash_content)
+    if directory is None or directory is True:
+        if os.path.isdir("/dev/shm"):
+            directory = "/dev/shm/hrds"
+        else:
+            directory = os.path.join(tempfile.gettempdir(), "hrds_node")
+    return DiskCache(directory)
+
+
+def attach(cache, key, build):
+    """
+    Find a shared stack, building it if no process has yet, and record
+    that this process is using it.
+
+    Args:
+        cache: the DiskCache the stacks are kept in
+        key: the key of the stack
+        build: a function that saves the stack to the filename given to it
+
+    Returns:
+        the filename of the stack
+    """
+    with _lock:
+        with _flock(cache.filename(key, ".build"), "LOCK_EX"):
+            filename = cache.get(key, ".hrds")
+            if filename is None:
+                filename = cache.put(key, ".hrds", build)
+            entry = _users.get((cache.directory, key))
+            if entry is None or entry[2] != os.getpid():
+                # (a forked child doesn't share its parent's users)
+                users = open(cache.filename(key, ".users"), "a")
+                if fcntl is not None:
+                    fcntl.flock(users, fcntl.LOCK_SH)
+                entry = [users, 0, os.getpid()]
+                _users[(cache.directory, key)] = entry
+            entry[1] += 1
+    return filename
+
+
+def leave(cache, key):
+    """
+    Record that one user of a shared stack in this process has finished
+    with it. If it was the last user on the node, the stack is removed.
+
+    Args:
+        cache: the DiskCache the stacks are kept in
+        key: the key of the stack
+    """
+    with _lock:
+        entry = _users.get((cache.directory, key))
+        if entry is None or entry[2] != os.getpid():
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _users[(cache.directory, key)]
+        users = entry[0]
+        try:
+            if fcntl is None:
+                return
+            with _flock(cache.filename(key, ".build"), "LOCK_EX"):
+                try:
+                    fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # still in use by another process
+                    return
+                _remove(cache.filename(key, ".hrds"))
+                _remove(cache.filename(key, ".users"))
+                # last, while still holding it; anyone waiting for it
+                # then makes a new one (see _flock)
+                _remove(cache.filename(key, ".build"))
+        finally:
+            users.close()
+
+
+@contextmanager
+def _flock(filename, operation):
+    # hold a lock on a file. If the file was removed (see leave) while
+    # waiting for the lock, the lock is of no use, so try again
+    while True:
+        f = open(filename, "a")
+        if fcntl is None:
+            break
+        fcntl.flock(f, getattr(fcntl, operation))
+        try:
+            if os.stat(filename).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    with f:
+        yield f
@@ -1,6 +1,15 @@
 import numpy as np
-from osgeo import gdal
+try:
+    from osgeo import gdal
+except ImportError:
+    # only arrays (e.g. an HRDS.load-ed stack) can be used
+    gdal = None
+from collections import OrderedDict
+from .cache import make_key, open_cache
+from .shared import is_shared, map_array, share_array
+import json
 import math
+import threading
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -22,6 +31,9 @@ This module contains the Interpolator class and the RasterInterpolator
 class. These RasterInterpolator class reads in a GDAL raster and
 then allows interagation of that data at an arbitrary point using
 bi-linear interpolation.
+
+GDAL is only needed to read rasters; a RasterInterpolator can also be made
+from an array with RasterInterpolator.from_array.
 """
 
 
@@ -133,12 +145,15 @@ class Interpolator():
                                           point, i, j)
 
             else:
-                # case without a land mask
+                # case without a land mask. The corner values are taken as
+                # python floats so the sum is done in double precision
+                # whatever the storage type of the raster (and matches
+                # get_vals exactly)
                 if len(self.val.shape) == 2:
-                    value = ((1.0-beta)*((1.0-alpha)*self.val[i, j] +
-                                         alpha*self.val[neigh_i, j]) +
-                             beta*((1.0-alpha)*self.val[i, neigh_j] +
-                                   alpha*self.val[neigh_i, neigh_j]))
+                    value = ((1.0-beta)*((1.0-alpha)*float(self.val[i, j]) +
+                                         alpha*float(self.val[neigh_i, j])) +
+                             beta*((1.0-alpha)*float(self.val[i, neigh_j]) +
+                                   alpha*float(self.val[neigh_i, neigh_j])))
                 else:
                     raise RasterInterpolatorError("Field to interpolate,"
                                                   "should have 2 dimensions")
@@ -155,6 +170,503 @@ class Interpolator():
 
         return value
 
+    def get_vals(self, points):
+        """
+        Get the value of this raster at many points at once via bi-linear
+        interpolation. This is the vectorised equivalent of get_val; the
+        indices, weights and min/max limits are computed for the whole
+        array in one go.
+
+        Args:
+            points: an (N, 2) array-like of x,y coordinates
+
+        Returns:
+            A tuple (values, outside). values is a length N numpy array of
+            the interpolated values and outside is a length N boolean
+            array which is True where get_val would have raised a
+            CoordinateError. The values at those points are NaN.
+
+        Raises:
+            RasterInterpolatorError: Generic error interpolating data
+        """
+        if len(self.val.shape) != 2:
+            raise RasterInterpolatorError("Field to interpolate,"
+                                          "should have 2 dimensions")
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        yhat = ((points[:, 0]+(self.delta[0]/2.0)-self.origin[0]) /
+                self.delta[0])
+        xhat = ((points[:, 1]+(self.delta[1]/2.0)-self.origin[1]) /
+                self.delta[1])
+        j = np.floor(yhat)-1
+        i = np.floor(xhat)-1
+        # written so that NaN coordinates end up outside too
+        inside = ((i >= 0) & (j >= 0) &
+                  (i+1 < self.val.shape[0]) & (j+1 < self.val.shape[1]))
+        i = i[inside].astype(np.intp)
+        j = j[inside].astype(np.intp)
+        alpha = np.mod(xhat[inside], 1.0)
+        beta = np.mod(yhat[inside], 1.0)
+        v00 = np.asarray(self.val[i, j], dtype=np.float64)
+        v10 = np.asarray(self.val[i+1, j], dtype=np.float64)
+        v01 = np.asarray(self.val[i, j+1], dtype=np.float64)
+        v11 = np.asarray(self.val[i+1, j+1], dtype=np.float64)
+        if self.mask is not None:
+            w00 = (1.0-alpha)*(1.0-beta)*self.mask[i, j]
+            w10 = alpha*(1.0-beta)*self.mask[i+1, j]
+            w01 = (1.0-alpha)*beta*self.mask[i, j+1]
+            w11 = alpha*beta*self.mask[i+1, j+1]
+            value = w00*v00 + w10*v10 + w01*v01 + w11*v11
+            sumw = w00+w10+w01+w11
+            # points inside the land mask are treated as out of range
+            land = np.logical_not(sumw > 0.0)
+            value = value/np.where(land, 1.0, sumw)
+            value[land] = np.nan
+        else:
+            value = ((1.0-beta)*((1.0-alpha)*v00 + alpha*v10) +
+                     beta*((1.0-alpha)*v01 + alpha*v11))
+            land = np.zeros(value.shape, dtype=bool)
+
+        if self.minmax is not None:
+            if self.minmax[0] is not None:
+                value = np.where(value < self.minmax[0],
+                                 self.minmax[0], value)
+            if self.minmax[1] is not None:
+                value = np.where(value > self.minmax[1],
+                                 self.minmax[1], value)
+
+        values = np.full(len(points), np.nan)
+        values[inside] = value
+        outside = np.logical_not(inside)
+        outside[inside] = land
+        return values, outside
+
+
+def replace_nans(data, nodata, rows=1024):
+    """
+    Replace any NaNs in an array with the no data value, in place. This is
+    done a strip of rows at a time, so needs little more memory than the
+    array itself.
+
+    Args:
+        data: the (2D) numpy array
+        nodata: the no data value. If None, the NaNs are left alone.
+        rows: the number of rows in each strip
+    """
+    if data.dtype.kind != 'f' or nodata is None:
+        return
+    for i in range(0, data.shape[0], rows):
+        strip = data[i:i+rows]
+        np.copyto(strip, nodata, where=np.isnan(strip))
+
+
+class TiledBand(object):
+    """
+    A read-only raster band that is read from disk in square blocks as
+    they are needed, rather than all at once. It is indexed exactly like
+    the (flipped) array that RasterInterpolator.set_band would otherwise
+    hold in memory, so can be handed straight to an Interpolator::
+
+        tb = TiledBand(ds.GetRasterBand(1), nodata, block_size=512)
+        tb[10, 20]
+
+    Blocks are kept in a least-recently-used cache which is trimmed
+    back to cache_bytes after each read. Resident memory is therefore
+    bounded by the cache size and the area actually queried, rather
+    than the size of the raster.
+
+    Blocks can be asked for from many threads at once; GDAL datasets
+    can't, so they are read one at a time.
+    """
+
+    def __init__(self, band, nodata=None, block_size=512,
+                 cache_bytes=256*1024**2, window=None):
+        """
+        Init our TiledBand
+
+        Args:
+            band: the GDAL raster band to read from
+            nodata: the no data value used to replace any NaNs
+            block_size: the size (in cells) of the square blocks to read
+            cache_bytes: the maximum amount of block data to keep
+            window: only use this part of the band, given as a pixel
+                window (xoff, yoff, xsize, ysize). Default is all of it.
+
+        Returns:
+            a TiledBand object
+        """
+        self.band = band
+        self.nodata = nodata
+        self.block_size = int(block_size)
+        self.cache_bytes = cache_bytes
+        if window is None:
+            window = (0, 0, band.XSize, band.YSize)
+        self.window = window
+        self.shape = (window[3], window[2])
+        self.dtype = band.ReadAsArray(0, 0, 1, 1).dtype
+        self.nblocks = (int(math.ceil(self.shape[0]/self.block_size)),
+                        int(math.ceil(self.shape[1]/self.block_size)))
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def read(self, i0=0, i1=None, j0=0, j1=None):
+        """
+        Read a window of the band straight from disk, in the same
+        orientation as the array set_band creates (i.e. row 0 is
+        at the bottom of the raster).
+
+        Args:
+            i0, i1: the range of (flipped) rows to read
+            j0, j1: the range of columns to read
+
+        Returns:
+            a numpy array with NaNs replaced by the no data value
+        """
+        if i1 is None:
+            i1 = self.shape[0]
+        if j1 is None:
+            j1 = self.shape[1]
+        data = self.band.ReadAsArray(self.window[0]+j0,
+                                     self.window[1]+self.shape[0]-i1,
+                                     j1-j0, i1-i0)[::-1]
+        replace_nans(data, self.nodata)
+        return data
+
+    def get_block(self, bi, bj):
+        """
+        Get a block of data, reading it if it is not already cached.
+
+        Args:
+            bi, bj: the block row and column
+
+        Returns:
+            a numpy array of (at most) block_size x block_size
+        """
+        key = (bi, bj)
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                return block
+            block = self.read(bi*self.block_size,
+                              min((bi+1)*self.block_size, self.shape[0]),
+                              bj*self.block_size,
+                              min((bj+1)*self.block_size, self.shape[1]))
+            self.blocks[key] = block
+            self.nbytes += block.nbytes
+            # always keep the block we have just read
+            while self.nbytes > self.cache_bytes and len(self.blocks) > 1:
+                self.nbytes -= self.blocks.popitem(last=False)[1].nbytes
+        return block
+
+    def __getitem__(self, index):
+        i, j = index
+        if np.ndim(i) == 0 and np.ndim(j) == 0:
+            if not (0 <= i < self.shape[0] and 0 <= j < self.shape[1]):
+                raise IndexError("index ({}, {}) is out of bounds for a "
+                                 "band of shape {}".format(i, j, self.shape))
+            bs = self.block_size
+            return self.get_block(i // bs, j // bs)[i % bs, j % bs]
+        i, j = np.broadcast_arrays(np.asarray(i, dtype=np.intp),
+                                   np.asarray(j, dtype=np.intp))
+        if (i.size > 0 and
+           (i.min() < 0 or j.min() < 0 or
+            i.max() >= self.shape[0] or j.max() >= self.shape[1])):
+            raise IndexError("index out of bounds for a band of "
+                             "shape {}".format(self.shape))
+        out = np.empty(i.shape, dtype=self.dtype)
+        i = i.ravel()
+        j = j.ravel()
+        flat = out.reshape(-1)
+        # visit each block once, gathering all the points within it
+        bi = i // self.block_size
+        bj = j // self.block_size
+        keys = bi*self.nblocks[1] + bj
+        order = np.argsort(keys, kind='stable')
+        starts = np.flatnonzero(np.diff(keys[order], prepend=-1))
+        ends = np.append(starts[1:], len(order))
+        for s, e in zip(starts, ends):
+            sel = order[s:e]
+            block = self.get_block(bi[sel[0]], bj[sel[0]])
+            flat[sel] = block[i[sel] % self.block_size,
+                              j[sel] % self.block_size]
+        return out
+
+
+class QuantizedBand(object):
+    """
+    A read-only raster band stored as small integers, with a scale and
+    offset, rather than floating point numbers::
+
+        qb = QuantizedBand(data, np.int16, nodata)
+        qb[10, 20]
+
+    It is indexed exactly like the array it was made from, giving back
+    values (as float64) which are within one quantization step of the
+    originals; that is, the error is at most::
+
+        (data.max() - data.min()) / (number of codes - 1)
+
+    which is given by max_error. For an int16 band of elevations spanning
+    10 km this is 0.15 m, in a quarter of the memory of float64 (half that
+    of float32). The lowest and highest codes are kept for values that
+    are exactly the smallest and largest, so a buffer stored as uint8
+    with limits (0, 1) is exactly 0 and 1 only where it should be: a
+    weight of 0.001 is given the next code up, not rounded to 0 (which
+    would drop the layer), and 0.999 the next code down.
+
+    If nodata is given and appears in the data (it is excluded from the
+    range), the lowest code is kept for it and it is given back exactly.
+    """
+
+    def __init__(self, data, dtype=np.int16, nodata=None, limits=None,
+                 rows=1024):
+        """
+        Init our QuantizedBand
+
+        Args:
+            data: the 2D numpy array to store
+            dtype: the integer type to store it as, e.g. np.int16,
+                np.uint16 or np.uint8
+            nodata: the no data value, if any
+            limits: the (min, max) of the values to store, if known, e.g.
+                (0, 1) for a buffer. Default is None (use those of the data)
+            rows: the number of rows to quantize at a time
+
+        Returns:
+            a QuantizedBand object
+        """
+        info = np.iinfo(dtype)
+        self.shape = data.shape
+        self.dtype = np.dtype(np.float64)
+        # what missing values are given back as
+        self.nodata = np.nan if nodata is None else nodata
+        # find the range of the data, and if there is any no data
+        has_nodata = False
+        vmin = np.inf
+        vmax = -np.inf
+        for i in range(0, self.shape[0], rows):
+            strip = data[i:i+rows]
+            missing = _missing(strip, nodata)
+            if missing.any():
+                has_nodata = True
+                strip = strip[np.logical_not(missing)]
+            if strip.size > 0:
+                vmin = min(vmin, float(strip.min()))
+                vmax = max(vmax, float(strip.max()))
+        if limits is not None:
+            vmin, vmax = float(limits[0]), float(limits[1])
+        elif vmin > vmax:
+            # nothing but no data
+            vmin = vmax = 0.0
+        self.vmin = vmin
+        self.span = vmax - vmin
+        # the code kept for no data, if needed
+        self.nodata_code = info.min if has_nodata else None
+        self.low = info.min + (1 if has_nodata else 0)
+        self.steps = info.max - self.low
+        self.max_error = self.span / self.steps
+        self.codes = np.empty(self.shape, dtype=dtype)
+        for i in range(0, self.shape[0], rows):
+            strip = data[i:i+rows]
+            if self.span > 0:
+                values = strip.astype(np.float64)
+                code = np.rint((values - self.vmin) *
+                               (self.steps / self.span))
+                # the end codes are only for the ends themselves
+                code = np.where(values > vmin, np.maximum(code, 1), code)
+                code = np.where(values < vmax,
+                                np.minimum(code, self.steps - 1), code)
+            else:
+                code = np.zeros(strip.shape)
+            code = np.clip(code + self.low, self.low, info.max)
+            if has_nodata:
+                code[_missing(strip, nodata)] = self.nodata_code
+            self.codes[i:i+rows] = code
+        self.nbytes = self.codes.nbytes
+
+    @classmethod
+    def from_codes(cls, codes, vmin, span, low, steps, nodata_code=None,
+                   nodata=None):
+        """
+        Make a QuantizedBand from codes that have already been worked out,
+        e.g. those kept by HRDS.save, without quantizing anything.
+
+        Args:
+            codes: the 2D numpy array (or memory map) of integer codes
+            vmin, span, low, steps, nodata_code: as the attributes of the
+                QuantizedBand the codes came from
+            nodata: the no data value, if any
+
+        Returns:
+            a QuantizedBand object
+        """
+        qb = cls.__new__(cls)
+        qb.codes = codes
+        qb.shape = codes.shape
+        qb.dtype = np.dtype(np.float64)
+        qb.nodata = np.nan if nodata is None else nodata
+        qb.vmin = vmin
+        qb.span = span
+        qb.low = low
+        qb.steps = steps
+        qb.nodata_code = nodata_code
+        qb.max_error = span / steps
+        qb.nbytes = codes.nbytes
+        return qb
+
+    def dequantize(self, codes):
+        """
+        Turn codes back into values.
+
+        Args:
+            codes: a numpy array (or scalar) of codes
+
+        Returns:
+            the values, as float64
+        """
+        values = self.vmin + ((np.asarray(codes, dtype=np.float64) -
+                               self.low) * self.span) / self.steps
+        if self.nodata_code is not None:
+            values = np.where(codes == self.nodata_code, self.nodata, values)
+        return values
+
+    def read(self, i0=0, i1=None, j0=0, j1=None):
+        """
+        Get a window of the band.
+
+        Args:
+            i0, i1: the range of rows
+            j0, j1: the range of columns
+
+        Returns:
+            a numpy array of values
+        """
+        return self.dequantize(self.codes[i0:i1, j0:j1])
+
+    def __getitem__(self, index):
+        return self.dequantize(self.codes[index])
+
+
+def _open(filename):
+    # open a raster, unless it is open already
+    if _is_dataset(filename):
+        return filename
+    if gdal is None:
+        raise RasterInterpolatorError("GDAL is needed to read " +
+                                      str(filename))
+    return gdal.Open(filename)
+
+
+def _read_vsimem(filename):
+    # the contents of a file in GDAL's in-memory filesystem
+    f = gdal.VSIFOpenL(filename, "rb")
+    if f is None:
+        return None
+    try:
+        gdal.VSIFSeekL(f, 0, 2)
+        size = gdal.VSIFTellL(f)
+        gdal.VSIFSeekL(f, 0, 0)
+        return gdal.VSIFReadL(1, size, f)
+    finally:
+        gdal.VSIFCloseL(f)
+
+
+def _is_dataset(filename):
+    # an open dataset, rather than a filename
+    return (isinstance(filename, ArrayDataset) or
+            (gdal is not None and isinstance(filename, gdal.Dataset)))
+
+
+def _missing(data, nodata):
+    # which values are NaN or no data
+    missing = np.isnan(data)
+    if nodata is not None:
+        missing |= data == nodata
+    return missing
+
+
+class ArrayDataset(object):
+    """
+    A raster held as an array (or memory map) rather than a file, with the
+    parts of a GDAL dataset that RasterInterpolator uses, so one can be
+    made without GDAL. See RasterInterpolator.from_array.
+    """
+
+    def __init__(self, val, extent, dx, nodata=None, projection=""):
+        """
+        Init our ArrayDataset
+
+        Args:
+            val: the 2D array, flipped so that row 0 is at the bottom, with
+                NaNs already replaced by the no data value (as
+                RasterInterpolator.val), or a QuantizedBand
+            extent: the corner coordinates, as RasterInterpolator.extent
+            dx: the cell size [dx, dy]
+            nodata: the no data value, if any
+            projection: the projection, as WKT
+
+        Returns:
+            an ArrayDataset object
+        """
+        self.extent = [[float(c) for c in corner] for corner in extent]
+        self.RasterYSize, self.RasterXSize = val.shape
+        xmin = min(corner[0] for corner in self.extent)
+        ymax = max(corner[1] for corner in self.extent)
+        self.geotransform = (xmin, float(dx[0]), 0.0, ymax, 0.0,
+                             -float(dx[1]))
+        self.projection = projection
+        self.band = ArrayBand(val, nodata)
+
+    def GetGeoTransform(self):
+        return self.geotransform
+
+    def GetProjection(self):
+        return self.projection
+
+    def GetRasterBand(self, band_no):
+        if band_no != 1:
+            raise RasterInterpolatorError("An array has only one band")
+        return self.band
+
+
+class ArrayBand(object):
+    """
+    The band of an ArrayDataset.
+    """
+
+    def __init__(self, val, nodata=None):
+        self.val = val
+        self.nodata = nodata
+        self.YSize, self.XSize = val.shape
+
+    def GetNoDataValue(self):
+        return self.nodata
+
+    def read(self, window):
+        """
+        Get a pixel window (xoff, yoff, xsize, ysize) of the band as
+        RasterInterpolator.set_band keeps it: flipped, with row 0 at the
+        bottom. The whole band is given back as is, not copied.
+        """
+        xoff, yoff, xsize, ysize = window
+        if tuple(window) == (0, 0, self.XSize, self.YSize):
+            return self.val
+        i0 = self.YSize - yoff - ysize
+        if isinstance(self.val, QuantizedBand):
+            return self.val.read(i0, i0 + ysize, xoff, xoff + xsize)
+        return self.val[i0:i0 + ysize, xoff:xoff + xsize]
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        if win_xsize is None:
+            win_xsize = self.XSize - xoff
+        if win_ysize is None:
+            win_ysize = self.YSize - yoff
+        data = self.read((xoff, yoff, win_xsize, win_ysize))
+        if isinstance(data, QuantizedBand):
+            data = data.read()
+        return np.array(data[::-1])
+
 
 # note that a RasterInterpolator is *not* object an Interpolator object
 # the latter is considered immutable, whereas the NetCDFInterpolator may
@@ -182,19 +694,69 @@ class RasterInterpolator(object):
     It is allowed to switch between different fields using multiple
     calls of set_band().
 
+    Large rasters can be read lazily, in blocks, as queries touch them,
+    rather than being loaded into memory in full by set_band()::
+
+        rci = RasterInterpolator('gebco.tif', lazy=True,
+                                 block_size=512, cache_bytes=1024**3)
+
+    Only the most recently used blocks, up to cache_bytes, are kept in
+    memory.
+
+    If only part of the raster is of interest, give a bounding box
+    (xmin, ymin, xmax, ymax) and only that region (plus a cell either
+    side, so interpolation is correct right up to the edge of the box)
+    will be read::
+
+        rci = RasterInterpolator('gebco.tif', bbox=[0, 0, 1000, 1000])
+
+    Points outside the bounding box are then treated as being outside
+    the raster.
+
+    To save memory, the raster can be kept as small integers (see
+    QuantizedBand), at the cost of a small, bounded, error in its values::
+
+        rci = RasterInterpolator('gebco.tif', quantize=np.int16)
+
+    This can't be used with lazy.
+
+    Decoding a large (compressed) raster can take a while. With an array
+    cache, the decoded band is stored on first use and memory mapped by
+    later runs, so set_band is almost instant and processes on the same
+    machine share one copy of it through the operating system::
+
+        rci = RasterInterpolator('gebco.tif', array_cache="/scratch/cache")
+
     """
-    def __init__(self, filename, minmax=None):
+    def __init__(self, filename, minmax=None, lazy=False, block_size=512,
+                 cache_bytes=256*1024**2, bbox=None, quantize=None,
+                 quantize_limits=None, array_cache=None):
         """
         Init our RasterInterpolator
 
         Args:
-            filename: Which raster to load
+            filename: Which raster to load, or an open GDAL dataset (such
+                as an in-memory buffer from CreateBuffer.make_buffer)
             minmax: any min/max values to adhere to (length 2 list [min,max])
+            lazy: read the raster in blocks as needed rather than in full
+            block_size: size (in cells) of the blocks read in lazy mode
+            cache_bytes: memory budget for cached blocks in lazy mode
+            bbox: only read the region (xmin, ymin, xmax, ymax) of the
+                raster. Default is None (the whole raster).
+            quantize: keep the raster as this integer type (e.g. np.int16)
+                with a scale and offset. Default is None (keep it as is).
+            quantize_limits: the (min, max) of the raster's values, if
+                known, when quantizing. Default is None (find them).
+            array_cache: a directory, True or DiskCache object in which to
+                keep the decoded band. Default is None (no cache).
 
         Returns:
             a RasterInterpolator object
         """
-        self.ds = gdal.Open(filename)
+        if lazy and quantize is not None:
+            raise RasterInterpolatorError("A raster can't be both lazy "
+                                          "and quantized")
+        self.ds = _open(filename)
         if (self.ds is None):
             raise RasterInterpolatorError("Couldn't find your raster file:" +
                                           filename + ". Exiting.")
@@ -202,24 +764,184 @@ class RasterInterpolator(object):
         self.mask = None
         self.interpolator = None
         self.extent = None
+        self.llc = None
+        self.urc = None
         self.dx = 0.0
         self.nodata = None
         self.minmax = minmax
+        self.lazy = lazy
+        self.block_size = block_size
+        self.cache_bytes = cache_bytes
+        self.bbox = bbox
+        self.quantize = quantize
+        self.quantize_limits = quantize_limits
+        self.filename = filename
+        # there is no file to check an open dataset against
+        self.array_cache = None
+        if not _is_dataset(filename):
+            self.array_cache = open_cache(array_cache)
+
+    @property
+    def ds(self):
+        """
+        The GDAL dataset (or ArrayDataset) of the raster. After unpickling,
+        the raster is only opened again when this is first used.
+        """
+        if self._ds is None:
+            self._ds = _open(self.filename)
+        return self._ds
+
+    @ds.setter
+    def ds(self, ds):
+        self._ds = ds
 
-    def get_extent(self):
+    def close(self):
+        """
+        Close the GDAL dataset until it is next needed (see ds), so that
+        many rasters that aren't in use yet don't each keep one open.
+        Open datasets given to the constructor (such as in-memory
+        buffers) can't be opened again, and lazy rasters read their blocks
+        from the dataset, so these are kept open.
+        """
+        if _is_dataset(self.filename):
+            return
+        if self.lazy and self.interpolator is not None:
+            return
+        self._ds = None
+
+    def keep_array(self):
+        """
+        Keep just the band read by set_band, in place of the dataset. An
+        in-memory GDAL dataset (such as a buffer from
+        CreateBuffer.make_buffer) is then freed, rather than kept as a
+        second (and, if quantized, larger) copy of the band. Only band 1,
+        the band read, can be used afterwards.
+        """
+        if self.interpolator is None or isinstance(self.val, TiledBand):
+            raise RasterInterpolatorError("Should call set_band() before "
+                                          "keep_array(), and not lazily")
+        self.ds = self._array_dataset()
+        self.filename = self.ds
+        self.band = 1
+        # what was read is already windowed and quantized
+        self.bbox = None
+        self.quantize = None
+        self.array_cache = None
+
+    def _array_dataset(self):
+        # an ArrayDataset of what set_band read
+        return ArrayDataset(self.val, self.extent, self.dx, self.nodata,
+                            self.ds.GetProjection())
+
+    def __getstate__(self):
+        # everything but the GDAL dataset, which can't be pickled. Shared
+        # and memory mapped arrays are sent as handles (see hrds.shared)
+        state = self.__dict__.copy()
+        if isinstance(self._ds, ArrayDataset):
+            return state
+        if _is_dataset(self.filename):
+            # an open dataset, such as an in-memory buffer, can't be opened
+            # again, so keep what was read from it
+            if self.interpolator is None or isinstance(self.val, TiledBand):
+                raise RasterInterpolatorError("A RasterInterpolator of an "
+                                              "open dataset can only be "
+                                              "pickled after set_band(), "
+                                              "and not lazily")
+            state["_ds"] = self._array_dataset()
+            state["filename"] = state["_ds"]
+            state["bbox"] = None
+            state["quantize"] = None
+            return state
+        state["_ds"] = None
+        if str(self.filename).startswith("/vsimem/"):
+            # e.g. a mosaic, which only exists in this process
+            state["_vsimem"] = _read_vsimem(self.filename)
+        if isinstance(self.val, TiledBand):
+            # the blocks are read again as needed
+            state["val"] = None
+            state["interpolator"] = None
+        return state
+
+    def __setstate__(self, state):
+        vsimem = state.pop("_vsimem", None)
+        self.__dict__.update(state)
+        if vsimem is not None and gdal.VSIStatL(self.filename) is None:
+            gdal.FileFromMemBuffer(self.filename, vsimem)
+        if self.lazy and self.interpolator is None and self.band is not None:
+            self.set_band(self.band)
+
+    def share(self):
+        """
+        Move the band into shared memory (see hrds.shared), so pickling
+        this RasterInterpolator, e.g. to send it to a pool of worker
+        processes, sends a handle to it rather than a copy. Memory mapped
+        bands (see array_cache) are already shared, and lazy ones are
+        read by each process, so are left as they are.
+
+        The shared memory is freed when the band is garbage collected in
+        this process.
+        """
+        if (self.interpolator is None):
+            raise RasterInterpolatorError("Should call set_band() "
+                                          "before calling share()!")
+        if isinstance(self.val, QuantizedBand):
+            self.val.codes = share_array(self.val.codes)
+        elif isinstance(self.val, np.ndarray) and not is_shared(self.val):
+            self.val = share_array(self.val)
+            if isinstance(self._ds, ArrayDataset):
+                self._ds.band.val = self.val
+            self.interpolator = Interpolator(self.interpolator.origin,
+                                             self.dx, self.val, self.mask,
+                                             self.minmax)
+
+    @classmethod
+    def from_array(cls, val, extent, dx, nodata=None, minmax=None,
+                   projection=""):
+        """
+        Make a RasterInterpolator from an array rather than a raster file,
+        ready to use (set_band has been called). GDAL is not needed::
+
+            rci = RasterInterpolator.from_array(val, extent, dx)
+
+        Args:
+            val: the 2D array (or memory map, or QuantizedBand) of values,
+                flipped so that row 0 is at the bottom and with no NaNs,
+                as RasterInterpolator.val is
+            extent: the corner coordinates, as RasterInterpolator.extent
+            dx: the cell size [dx, dy]
+            nodata: the no data value, if any
+            minmax: any min/max values to adhere to (length 2 list [min,max])
+            projection: the projection, as WKT
+
+        Returns:
+            a RasterInterpolator object
+        """
+        rci = cls(ArrayDataset(val, extent, dx, nodata, projection), minmax)
+        rci.set_band()
+        return rci
+
+    def get_extent(self, window=None):
         """Return list of corner coordinates from a geotransform
 
+        Args:
+            window: the extent of this pixel window (xoff, yoff, xsize,
+                ysize) rather than the whole raster. Default is None.
+
         Returns:
             List continaing the corner coordinates of the raster
 
         """
-        cols = self.ds.RasterXSize
-        rows = self.ds.RasterYSize
+        if window is None:
+            window = (0, 0, self.ds.RasterXSize, self.ds.RasterYSize)
+        if (isinstance(self.ds, ArrayDataset) and tuple(window) ==
+                (0, 0, self.ds.RasterXSize, self.ds.RasterYSize)):
+            # exactly as it was given
+            return [list(corner) for corner in self.ds.extent]
         gt = self.ds.GetGeoTransform()
 
         ext = []
-        xarr = [0, cols]
-        yarr = [0, rows]
+        xarr = [window[0], window[0]+window[2]]
+        yarr = [window[1], window[1]+window[3]]
 
         for px in xarr:
             for py in yarr:
@@ -229,6 +951,48 @@ class RasterInterpolator(object):
             yarr.reverse()
         return ext
 
+    def get_box(self):
+        """
+        The region in which points can be interpolated: the extent less
+        half a cell all round. This is what point_in tests against, but
+        is available before set_band() has been called.
+
+        Returns:
+            A tuple (llc, urc) of the lower left and upper right corners
+        """
+        extent = self.get_extent(self.get_pixel_window())
+        gt = self.ds.GetGeoTransform()
+        dx = [gt[1], -gt[5]]
+        llc = np.amin(extent, axis=0)+(dx[0]/2)
+        urc = np.amax(extent, axis=0)-(dx[1]/2)
+        return llc, urc
+
+    def get_pixel_window(self):
+        """
+        Work out which part of the raster covers our bounding box, plus a
+        cell either side.
+
+        Returns:
+            The pixel window (xoff, yoff, xsize, ysize), counting rows
+            from the top of the raster as GDAL does. This is the whole
+            raster if no bounding box was given.
+        """
+        cols = self.ds.RasterXSize
+        rows = self.ds.RasterYSize
+        if self.bbox is None:
+            return (0, 0, cols, rows)
+        gt = self.ds.GetGeoTransform()
+        xmin, ymin, xmax, ymax = self.bbox
+        col0 = int(math.floor((xmin - gt[0]) / gt[1])) - 1
+        col1 = int(math.ceil((xmax - gt[0]) / gt[1])) + 1
+        row0 = int(math.floor((ymax - gt[3]) / gt[5])) - 1
+        row1 = int(math.ceil((ymin - gt[3]) / gt[5])) + 1
+        col0 = min(max(col0, 0), cols)
+        col1 = min(max(col1, 0), cols)
+        row0 = min(max(row0, 0), rows)
+        row1 = min(max(row1, 0), rows)
+        return (col0, row0, col1-col0, row1-row0)
+
     def set_band(self, band_no=1):
         """
         Set the number of the band to be used. Usually 1, which is default
@@ -240,20 +1004,102 @@ class RasterInterpolator(object):
         self.band = band_no
         raster = self.ds.GetRasterBand(self.band)
         self.nodata = raster.GetNoDataValue()
-        self.val = np.flipud(np.array(raster.ReadAsArray()))
-        # fix any NAN with the no-data value
-        if (np.isnan(self.val).any()):
-            self.val[np.isnan(self.val)] = self.nodata
-        self.extent = self.get_extent()
+        window = self.get_pixel_window()
+        if window[2] == 0 or window[3] == 0:
+            raise RasterInterpolatorError("The bounding box " +
+                                          str(self.bbox) + " does not "
+                                          "overlap the raster")
+        if isinstance(raster, ArrayBand):
+            # already flipped and without NaNs
+            self.val = raster.read(window)
+        elif self.lazy:
+            self.val = TiledBand(raster, self.nodata, self.block_size,
+                                 self.cache_bytes, window)
+        elif self.array_cache is not None:
+            self.val = self.cached_array(raster, window)
+        else:
+            self.val = self.read_array(raster, window)
+        if self.quantize is not None:
+            # never lazy, see __init__
+            self.val = QuantizedBand(self.val, self.quantize,
+                                     self.nodata, self.quantize_limits)
+        self.extent = self.get_extent(window)
         origin = np.amin(self.extent, axis=0)
         transform = self.ds.GetGeoTransform()
         self.dx = [transform[1], -transform[5]]
+        # the region in which points can be interpolated (see point_in)
+        self.llc, self.urc = self.get_box()
         self.interpolator = Interpolator(origin, self.dx, self.val,
                                          self.mask, self.minmax)
 
+    def read_array(self, raster, window):
+        """
+        Read (part of) a band into memory.
+
+        Args:
+            raster: the GDAL band
+            window: the pixel window (xoff, yoff, xsize, ysize) to read
+
+        Returns:
+            a numpy array, flipped so that row 0 is at the bottom, with
+            NaNs replaced by the no data value
+        """
+        # kept in the raster's own data type, and flipped as a view
+        # rather than a copy, so the band is only in memory once
+        val = raster.ReadAsArray(*window)[::-1]
+        # fix any NAN with the no-data value
+        replace_nans(val, self.nodata)
+        return val
+
+    def cached_array(self, raster, window):
+        """
+        Read (part of) a band from the array cache, as a read-only memory
+        map. If it is not cached, it is read with read_array and stored as
+        a .npy file, with a .json file describing it.
+
+        Args:
+            raster: the GDAL band
+            window: the pixel window (xoff, yoff, xsize, ysize) to read
+
+        Returns:
+            a numpy array (or memory map) as read_array
+        """
+        cache = self.array_cache
+        key = make_key("array", cache.signature(self.filename), self.band,
+                       tuple(int(w) for w in window))
+        shape = [int(window[3]), int(window[2])]
+        filename = cache.get(key, ".npy")
+        if filename is not None:
+            try:
+                with open(cache.filename(key, ".json")) as f:
+                    meta = json.load(f)
+                val = np.load(filename, mmap_mode='r')
+                if list(val.shape) == shape and meta["shape"] == shape:
+                    return map_array(filename, val.dtype, val.shape,
+                                     val.offset)
+            except (OSError, ValueError, KeyError):
+                # evicted, or half written, by another process
+                pass
+        val = self.read_array(raster, window)
+        meta = {"filename": str(self.filename), "band": self.band,
+                "window": [int(w) for w in window], "shape": shape,
+                "dtype": val.dtype.str, "nodata": self.nodata,
+                "geotransform": list(self.ds.GetGeoTransform()),
+                "projection": self.ds.GetProjection()}
+
+        def write_meta(meta_file):
+            with open(meta_file, "w") as f:
+                json.dump(meta, f)
+
+        # the description goes first, so is there when the array is
+        cache.put(key, ".json", write_meta)
+        cache.put(key, ".npy", lambda array_file: np.save(array_file, val))
+        return val
+
     def get_array(self):
         """
-        Get the raw data in the raster
+        Get the raw data in the raster. In lazy mode this reads
+        the whole band from disk.
 
         Returns:
             a numpy array containing the raster data
@@ -261,6 +1107,8 @@ class RasterInterpolator(object):
         if (self.interpolator is None):
             raise RasterInterpolatorError("Should call set_band() "
                                           "before calling get_array()!")
+        if isinstance(self.val, (TiledBand, QuantizedBand)):
+            return self.val.read()
         return self.val
 
     def get_val(self, x):
@@ -287,6 +1135,41 @@ class RasterInterpolator(object):
         val = self.interpolator.get_val(x)
         return val
 
+    def get_vals(self, points):
+        """
+        Interpolate the field chosen with set_band() at many points
+        at once. See Interpolator.get_vals.
+
+        Args:
+            points: an (N, 2) array-like of x,y coordinates
+
+        Returns:
+            A tuple (values, outside) of length N numpy arrays. outside
+            is True for points that are off the raster; their value is NaN.
+
+        Raises:
+            RasterInterpolatorError: set_band() has not been called
+        """
+        if (self.interpolator is None):
+            raise RasterInterpolatorError("Should call set_band() "
+                                          "before calling get_vals()!")
+        return self.interpolator.get_vals(points)
+
+    def overlaps(self, bbox):
+        """
+        Does any of the raster lay inside a bounding box?
+
+        Args:
+            bbox: (xmin, ymin, xmax, ymax)
+
+        Returns:
+            Boolean. True if the raster and the box overlap.
+        """
+        llc = np.amin(self.get_extent(), axis=0)
+        urc = np.amax(self.get_extent(), axis=0)
+        return (bbox[0] <= urc[0] and bbox[2] >= llc[0] and
+                bbox[1] <= urc[1] and bbox[3] >= llc[1])
+
     def point_in(self, point):
         """
         Does a point lay inside a raster's extent?
@@ -299,10 +1182,28 @@ class RasterInterpolator(object):
         """
 
         # does this point occur in the raster?
-        llc = np.amin(self.extent, axis=0)+(self.dx[0]/2)
-        urc = np.amax(self.extent, axis=0)-(self.dx[1]/2)
+        llc = self.llc
+        urc = self.urc
         if ((point[0] <= urc[0] and point[0] >= llc[0]) and
            (point[1] <= urc[1] and point[1] >= llc[1])):
             return True
         else:
             return False
+
+    def points_in(self, points):
+        """
+        Which of the points lay inside a raster's extent? Vectorised
+        version of point_in.
+
+        Args:
+            points: an (N, 2) array-like of x,y coordinates
+
+        Returns:
+            A length N boolean numpy array. True where the point is in
+            the raster.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        llc = self.llc
+        urc = self.urc
+        return ((points[:, 0] <= urc[0]) & (points[:, 0] >= llc[0]) &
+                (points[:, 1] <= urc[1]) & (points[:, 1] >= llc[1]))
@@ -1,8 +1,13 @@
 import numpy as np
-from osgeo import gdal
+try:
+    from osgeo import gdal
+except ImportError:
+    # see raster.py
+    gdal = None
 from .raster import RasterInterpolator
-from scipy.ndimage import distance_transform_edt
-from math import ceil
+from scipy.ndimage import distance_transform_edt, maximum_filter
+from math import ceil, floor
+from concurrent.futures import ProcessPoolExecutor
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -47,10 +52,45 @@ class CreateBuffer():
 
         rbuff.make_buffer('output_buffer.tif')
 
+    or, if you don't need the file, keep it in memory and use it
+    directly::
+
+        buf = RasterInterpolator(rbuff.make_buffer())
+
+    If only part of the raster is of interest, give a bounding box
+    (xmin, ymin, xmax, ymax) and the buffer will only be created over
+    that region (plus a cell either side)::
+
+        rbuff = CreateBuffer('myRaster.tif', 10000.0,
+                             bbox=[0, 0, 50000, 50000])
+
+    The buffer values are exactly those of the full buffer raster, as
+    distances are still measured to the real edges of the raster, but
+    only the part of the raster within the buffer distance of the box
+    is read.
+
+    Distances are only calculated within the buffer distance of the edges
+    of the raster and any no data (the "narrow band"); everywhere else the
+    buffer is simply 1. Set narrow_band=False to calculate the distance
+    transform over the whole raster instead.
+
+    Gaps in the data are expanded by one cell before the buffer is
+    created. To expand them further, give the distance to expand them by,
+    e.g. expand=50.0. This is done in a single pass, however far.
+
+    Very large rasters can be buffered tile by tile, so the whole raster
+    (and buffer) is never in memory at once. Tiles can be created on a
+    pool of processes::
+
+        rbuff = CreateBuffer('myRaster.tif', 500.0, tile_size=4096)
+        rbuff.make_buffer('output_buffer.tif', workers=8)
+
     Any GDAL-understood file format is supported for input or output.
     """
 
-    def __init__(self, filename, distance, over=None):
+    def __init__(self, filename, distance, over=None, bbox=None,
+                 narrow_band=True, block_size=256, tile_size=None,
+                 expand=None):
         """
         Init our buffer
 
@@ -58,44 +98,71 @@ class CreateBuffer():
             filename: filename to write to
             distance: distance (in raster units) to extend buffer over
             over: alter the distance to be in some other units
+            bbox: only create the buffer over this region (xmin, ymin,
+                xmax, ymax). Default is None (the whole raster).
+            narrow_band: only calculate distances near the edges and no
+                data, where the buffer is less than 1. Default is True.
+            block_size: the (minimum) size of the blocks, in cells, the
+                narrow band is split into. Default is 256.
+            tile_size: create the buffer in tiles of this many cells,
+                reading the raster as needed. Default is None (create
+                the buffer in one go).
+            expand: distance (in raster units) to expand any no data
+                by. Default is None (expand by one cell).
 
         Returns:
             a createBuffer object
         """
         self.distance = distance
         self.over = over
-        self.raster = RasterInterpolator(filename)
-        self.raster.set_band()
+        self.bbox = bbox
+        self.narrow_band = narrow_band
+        self.block_size = block_size
+        self.tile_size = tile_size
+        self.expand = expand
+        self.filename = filename
+        # when tiling, only the parts of the raster needed are read
+        self.raster = RasterInterpolator(filename,
+                                         lazy=tile_size is not None)
         self.extent = self.raster.get_extent()
+        self.nodata_present = None
+        if bbox is not None:
+            # we need the raster out to the buffer distance (and
+            # a couple of cells more) beyond our region
+            dx, nx, ny = self.get_grid()
+            pad = (self.get_halo(dx) + 2) * max(dx)
+            self.raster.bbox = [bbox[0] - pad, bbox[1] - pad,
+                                bbox[2] + pad, bbox[3] + pad]
+        self.raster.set_band()
 
-    def __write_raster__(self, filename, array, dx, origin, proj):
+    def __create_raster__(self, filename, x_pixels, y_pixels, dx, origin,
+                          proj, driver_name='GTiff', options=None):
         """
-        Write raster to file
+        Create an empty raster
 
         Args:
             filename: filename to write to
-            array: the data. 2D numpy array
+            x_pixels, y_pixels: size of the raster
             dx: resolution (length 2 list)
             origin: the LLC coordinates
             proj: Projection space for the raster (wkt)
+            driver_name: the GDAL driver to use. Default is 'GTiff'
+            options: list of GDAL creation options. Default is None
 
         Returns:
-            Nothing
+            The GDAL dataset
         """
-        dst_filename = filename
-        x_pixels = array.shape[1]
-        y_pixels = array.shape[0]
         x_min = origin[0][0]
         y_max = origin[0][1] + dx[1]*y_pixels
-        wkt_projection = proj
 
-        driver = gdal.GetDriverByName('GTiff')
+        driver = gdal.GetDriverByName(driver_name)
         dataset = driver.Create(
-            dst_filename,
+            filename,
             x_pixels,
             y_pixels,
             1,
-            gdal.GDT_Float32)
+            gdal.GDT_Float32,
+            options=options or [])
 
         dataset.SetGeoTransform((
             x_min,       # 0
@@ -105,10 +172,31 @@ class CreateBuffer():
             0,           # 4
             -dx[1]))
 
-        dataset.SetProjection(wkt_projection)
+        dataset.SetProjection(proj)
+        return dataset
+
+    def __write_raster__(self, filename, array, dx, origin, proj,
+                         driver_name='GTiff'):
+        """
+        Write raster to file
+
+        Args:
+            filename: filename to write to
+            array: the data. 2D numpy array
+            dx: resolution (length 2 list)
+            origin: the LLC coordinates
+            proj: Projection space for the raster (wkt)
+            driver_name: the GDAL driver to use. Default is 'GTiff'
+
+        Returns:
+            The GDAL dataset
+        """
+        dataset = self.__create_raster__(filename, array.shape[1],
+                                         array.shape[0], dx, origin, proj,
+                                         driver_name)
         dataset.GetRasterBand(1).WriteArray(array)
         dataset.FlushCache()
-        return
+        return dataset
 
     def extend_mask(self, array, iterations):
         """
@@ -122,71 +210,353 @@ class CreateBuffer():
             a numpy array
         """
 
-        # function to extend a mask array.
-        output = array.copy()
-        for i in range(iterations):
-            output[1:, :] = np.maximum(output[1:, :], array[:-1, :])
-            output[:-1, :] = np.maximum(output[:-1, :], array[1:, :])
-            output[:, 1:] = np.maximum(output[:, 1:], array[:, :-1])
-            output[:, :-1] = np.maximum(output[:, :-1], array[:, 1:])
-            output[1:, 1:] = np.maximum(output[1:, 1:], array[:-1, :-1])
-            # Diagonals
-            output[1:, 1:] = np.maximum(output[1:, 1:], array[:-1, :-1])
-            output[1:, :-1] = np.maximum(output[1:, :-1], array[:-1, 1:])
-            output[:-1, 1:] = np.maximum(output[:-1, 1:], array[1:, :-1])
-            output[:-1, :-1] = np.maximum(output[:-1, :-1], array[1:, 1:])
-            array = output.copy()
-        return output
-
-    def make_buffer(self, output_file):
+        # extending by one cell, n times, is the same as taking the
+        # maximum over a (2n+1) square, which is done in a single pass
+        # whatever the size
+        return maximum_filter(array, size=2 * iterations + 1, mode='nearest')
+
+    def dilate(self, mask, radius, dx):
         """
-        Create a buffer raster from 0 to 1 over a set distance.
+        Extend a mask by a distance, in map units, in all directions.
+        Unlike extend_mask this grows the mask by a circle, rather than
+        a square, and the cost does not depend on the distance.
 
         Args:
-            output_file: where to save this raster
+            mask: the boolean numpy array to extend
+            radius: how far to extend the mask (in raster units)
+            dx: resolution of the mask (length 2 list)
+
+        Returns:
+            a boolean numpy array
         """
+        if not mask.any():
+            return mask.copy()
+        dist = distance_transform_edt(np.logical_not(mask),
+                                      sampling=[dx[0], dx[1]])
+        return dist <= radius
 
-        # make a raster of the same extent, but with
-        # square resolution which is dependant on distance buffer
+    def get_grid(self):
+        """
+        The resolution and size of the buffer raster. This is the grid of
+        the raster itself, unless "over" is set.
 
+        Returns:
+            dx (length 2 list), and the number of cells in x and y
+        """
         llc = self.extent[1]
         urc = self.extent[3]
         if self.over is None:
             transform = self.raster.ds.GetGeoTransform()
             dx = [transform[1], -transform[5]]
-            nrows = self.raster.ds.RasterXSize
-            ncols = self.raster.ds.RasterYSize
+            nx = self.raster.ds.RasterXSize
+            ny = self.raster.ds.RasterYSize
         else:
             dx = [self.distance / self.over, self.distance / self.over]
             # note this changes our extent if "over" is set
-            nrows = int(ceil((urc[0] - llc[0]) / dx[0]))
-            ncols = int(ceil((urc[1] - llc[1]) / dx[1]))
-
-        # fill with edge value
-        dist = np.full((ncols, nrows), 0.0)
-        # then fill in the middle,
-        # except where there is no data
-        dist[1:-1, 1:-1] = 1
+            nx = int(ceil((urc[0] - llc[0]) / dx[0]))
+            ny = int(ceil((urc[1] - llc[1]) / dx[1]))
+        return dx, nx, ny
+
+    def get_halo(self, dx):
+        """
+        How many cells beyond a window of the buffer can affect the
+        values within it.
+
+        Args:
+            dx: resolution of the buffer (length 2 list)
+
+        Returns:
+            an integer number of cells
+        """
+        # the buffer distance, plus the extension of the no data mask
+        if self.expand is None:
+            return int(ceil(self.distance / min(dx))) + 1
+        return int(ceil((self.distance + self.expand) / min(dx))) + 1
+
+    def get_window(self, bbox, dx, nx, ny):
+        """
+        The rows and columns of the buffer grid covering a bounding box,
+        plus a cell either side.
+
+        Args:
+            bbox: (xmin, ymin, xmax, ymax)
+            dx: resolution of the buffer (length 2 list)
+            nx, ny: size of the buffer grid
+
+        Returns:
+            row and column ranges r0, r1, c0, c1. Rows are counted
+            from the bottom of the raster.
+        """
+        llc = self.extent[1]
+        c0 = int(floor((bbox[0] - llc[0]) / dx[0])) - 1
+        c1 = int(ceil((bbox[2] - llc[0]) / dx[0])) + 1
+        r0 = int(floor((bbox[1] - llc[1]) / dx[1])) - 1
+        r1 = int(ceil((bbox[3] - llc[1]) / dx[1])) + 1
+        return (min(max(r0, 0), ny), min(max(r1, 0), ny),
+                min(max(c0, 0), nx), min(max(c1, 0), nx))
+
+    def has_nodata(self):
+        """
+        Does the raster contain any no data values anywhere?
+        If we only hold part of the raster, this is found by
+        reading through the rest in strips.
+
+        Returns:
+            Boolean
+        """
+        if self.nodata_present is not None:
+            return self.nodata_present
+        nodata = self.raster.nodata
+        if self.raster.bbox is None and not self.raster.lazy:
+            self.nodata_present = bool(nodata in self.raster.get_array())
+            return self.nodata_present
+        self.nodata_present = False
+        # NaNs are swapped for the no data value when read in, so a NaN
+        # counts, but a NaN (or no) no data value never matches anything
+        if nodata is None or nodata != nodata:
+            return self.nodata_present
+        band = self.raster.ds.GetRasterBand(self.raster.band)
+        nrows = self.raster.ds.RasterYSize
+        for row in range(0, nrows, 256):
+            strip = band.ReadAsArray(0, row, self.raster.ds.RasterXSize,
+                                     min(256, nrows - row))
+            if (nodata in strip or
+               (strip.dtype.kind == 'f' and np.isnan(strip).any())):
+                self.nodata_present = True
+                break
+        return self.nodata_present
+
+    def get_seed(self, r0, r1, c0, c1, nx, ny):
+        """
+        Mark where the buffer is zero (the edge of the raster and any no
+        data) for a window of the buffer grid.
+
+        Args:
+            r0, r1, c0, c1: the window, rows counted from the bottom
+            nx, ny: size of the buffer grid
+
+        Returns:
+            a boolean numpy array, False where the buffer is zero
+        """
+        seed = np.full((r1 - r0, c1 - c0), True)
+        # the edges of the raster
+        if r0 == 0:
+            seed[0, :] = False
+        if r1 == ny:
+            seed[-1, :] = False
+        if c0 == 0:
+            seed[:, 0] = False
+        if c1 == nx:
+            seed[:, -1] = False
         if self.over is None:
-            orig_raster = self.raster.get_array()
-            nodata = self.raster.nodata
-            # TODO this will only work if dist and orig_raster
-            # are the same size
-            dist[orig_raster == nodata] = 0
+            # the raster may only be held in part, so offset to it
+            xoff, yoff, xsize, ysize = self.raster.get_pixel_window()
+            roff = ny - yoff - ysize
+            if self.raster.lazy:
+                orig_raster = self.raster.val.read(r0 - roff, r1 - roff,
+                                                   c0 - xoff, c1 - xoff)
+            else:
+                orig_raster = self.raster.get_array()[r0 - roff:r1 - roff,
+                                                      c0 - xoff:c1 - xoff]
+            seed[orig_raster == self.raster.nodata] = False
             # they also be nan...(shouldn't as we swap it out...)
-            dist[np.isnan(orig_raster)] = 0
+            seed[np.isnan(orig_raster)] = False
             # we now extend this mask - we only need to do this, if the
             # no data occurs (i.e. no contiguous data)
-            if (nodata in orig_raster):
-                mask = np.full((ncols, nrows), False)
-                mask[dist == 0] = True
-                mask = self.extend_mask(mask, 1)
-                dist[mask] = 0
-        # calc euclidian distance and convert to 0 -> 1 scale
-        dist = distance_transform_edt(dist, sampling=[dx[0], dx[1]])
-        dist = dist / self.distance
-        dist[dist > 1] = 1.0
-
-        # create a suitable output filename
-        self.__write_raster__(output_file, np.flipud(dist), dx, [llc, urc],
+            if self.has_nodata():
+                if self.expand is None:
+                    seed = np.logical_not(self.extend_mask(
+                        np.logical_not(seed), 1))
+                else:
+                    dx, nx, ny = self.get_grid()
+                    seed = np.logical_not(self.dilate(
+                        np.logical_not(seed), self.expand, dx))
+        return seed
+
+    def get_buffer(self, r0, r1, c0, c1):
+        """
+        Calculate the buffer over a window of the buffer grid. The
+        window is padded so that the distances are the same as
+        those over the whole grid.
+
+        Args:
+            r0, r1, c0, c1: the window, rows counted from the bottom
+
+        Returns:
+            a numpy array of the buffer (0 -> 1) in the window
+        """
+        dx, nx, ny = self.get_grid()
+        halo = self.get_halo(dx) + 1
+        er0 = max(r0 - halo, 0)
+        er1 = min(r1 + halo, ny)
+        ec0 = max(c0 - halo, 0)
+        ec1 = min(c1 + halo, nx)
+        seed = self.get_seed(er0, er1, ec0, ec1, nx, ny)
+        if seed.all():
+            # nothing within the buffer distance
+            return np.full((r1 - r0, c1 - c0), 1.0)
+        if not self.narrow_band:
+            # calc euclidian distance and convert to 0 -> 1 scale
+            dist = distance_transform_edt(seed, sampling=[dx[0], dx[1]])
+            dist = dist[r0 - er0:r1 - er0, c0 - ec0:c1 - ec0]
+            dist = dist / self.distance
+            dist[dist > 1] = 1.0
+            return dist
+        return self.get_narrow_band(seed, r0 - er0, r1 - er0,
+                                    c0 - ec0, c1 - ec0, dx)
+
+    def get_narrow_band(self, seed, r0, r1, c0, c1, dx):
+        """
+        Calculate the buffer only where it is less than 1. The window
+        is split into blocks and the distance transform is only done on
+        blocks that have a zero in the seed within the buffer distance;
+        the rest are simply 1. The cost therefore scales with the area
+        of the band around the edges and no data, not the raster.
+
+        Args:
+            seed: the seed (see get_seed), covering the window plus
+                a halo of at least the buffer distance
+            r0, r1, c0, c1: the window within the seed
+            dx: resolution of the buffer (length 2 list)
+
+        Returns:
+            a numpy array of the buffer (0 -> 1) in the window
+        """
+        halo = self.get_halo(dx)
+        block = max(self.block_size, 2 * halo)
+        dist = np.full((r1 - r0, c1 - c0), 1.0)
+        # which (coarse) blocks of the seed contain a zero
+        nbr = int(ceil(seed.shape[0] / block))
+        nbc = int(ceil(seed.shape[1] / block))
+        zeros = np.logical_not(seed)
+        padded = np.zeros((nbr * block, nbc * block), dtype=bool)
+        padded[:seed.shape[0], :seed.shape[1]] = zeros
+        coarse = padded.reshape(nbr, block, nbc, block).any(axis=(1, 3))
+        del padded
+        for i in range(r0, r1, block):
+            for j in range(c0, c1, block):
+                i1 = min(i + block, r1)
+                j1 = min(j + block, c1)
+                # the block plus its halo
+                hi0 = max(i - halo, 0)
+                hi1 = min(i1 + halo, seed.shape[0])
+                hj0 = max(j - halo, 0)
+                hj1 = min(j1 + halo, seed.shape[1])
+                if not coarse[hi0 // block:(hi1 - 1) // block + 1,
+                              hj0 // block:(hj1 - 1) // block + 1].any():
+                    continue
+                if not zeros[hi0:hi1, hj0:hj1].any():
+                    continue
+                d = distance_transform_edt(seed[hi0:hi1, hj0:hj1],
+                                           sampling=[dx[0], dx[1]])
+                d = d[i - hi0:i1 - hi0, j - hj0:j1 - hj0] / self.distance
+                d[d > 1] = 1.0
+                dist[i - r0:i1 - r0, j - c0:j1 - c0] = d
+        return dist
+
+    def make_buffer(self, output_file=None, workers=None):
+        """
+        Create a buffer raster from 0 to 1 over a set distance.
+
+        Args:
+            output_file: where to save this raster. If None, the raster
+                is kept in memory instead.
+            workers: if tile_size is set, the number of processes to
+                create the tiles on. Default is None (no extra processes).
+
+        Returns:
+            The in-memory GDAL dataset if output_file is None,
+            otherwise None.
+        """
+
+        # make a raster of the same extent, but with
+        # square resolution which is dependant on distance buffer
+        dx, nx, ny = self.get_grid()
+        if self.bbox is None:
+            r0, r1, c0, c1 = 0, ny, 0, nx
+        else:
+            r0, r1, c0, c1 = self.get_window(self.bbox, dx, nx, ny)
+        llc = [self.extent[1][0] + c0 * dx[0], self.extent[1][1] + r0 * dx[1]]
+
+        if self.tile_size is not None:
+            return self.make_tiled_buffer(output_file, r0, r1, c0, c1, dx,
+                                          [llc], workers)
+        dist = self.get_buffer(r0, r1, c0, c1)
+        if output_file is None:
+            return self.__write_raster__('', np.flipud(dist), dx, [llc],
+                                         self.raster.ds.GetProjection(),
+                                         'MEM')
+        self.__write_raster__(output_file, np.flipud(dist), dx, [llc],
                               self.raster.ds.GetProjection())
+
+    def make_tiled_buffer(self, output_file, r0, r1, c0, c1, dx, origin,
+                          workers=None):
+        """
+        Create the buffer tile by tile, streaming each into the output
+        raster as it is done. Each tile is computed independently with a
+        halo of the buffer distance, so the result is identical to
+        creating the buffer in one go.
+
+        Args:
+            output_file: where to save this raster, or None to keep it
+                in memory
+            r0, r1, c0, c1: the window of the buffer grid to create, rows
+                counted from the bottom
+            dx: resolution (length 2 list)
+            origin: the LLC coordinates
+            workers: number of processes to create the tiles on
+
+        Returns:
+            The in-memory GDAL dataset if output_file is None,
+            otherwise None.
+        """
+        if output_file is None:
+            dataset = self.__create_raster__('', c1 - c0, r1 - r0, dx,
+                                             origin,
+                                             self.raster.ds.GetProjection(),
+                                             'MEM')
+        else:
+            dataset = self.__create_raster__(output_file, c1 - c0, r1 - r0,
+                                             dx, origin,
+                                             self.raster.ds.GetProjection(),
+                                             options=['TILED=YES',
+                                                      'BIGTIFF=IF_SAFER'])
+        band = dataset.GetRasterBand(1)
+        size = self.tile_size
+        tiles = [(i, min(i + size, r1), j, min(j + size, c1))
+                 for i in range(r0, r1, size) for j in range(c0, c1, size)]
+
+        def write(tile, dist):
+            # rows are counted from the top in the file
+            band.WriteArray(np.flipud(dist), tile[2] - c0, r1 - tile[1])
+
+        if workers is None or workers < 2:
+            for tile in tiles:
+                write(tile, self.get_buffer(*tile))
+        else:
+            if not isinstance(self.filename, str):
+                raise ValueError("Buffers can only be created on multiple "
+                                 "processes from a raster file")
+            args = (self.filename, self.distance, self.over, self.bbox,
+                    self.narrow_band, self.block_size, self.tile_size,
+                    self.expand)
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=args) as pool:
+                for tile, dist in zip(tiles, pool.map(_worker_buffer, tiles)):
+                    write(tile, dist)
+        dataset.FlushCache()
+        if output_file is None:
+            return dataset
+
+
+# the CreateBuffer used by each process when tiling in parallel
+_worker = None
+
+
+def _init_worker(*args):
+    global _worker
+    _worker = CreateBuffer(*args)
+
+
+def _worker_buffer(tile):
+    return _worker.get_buffer(*tile)
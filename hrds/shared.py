@@ -0,0 +1,189 @@
+import threading
+import weakref
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+"""
+This module contains arrays that are pickled as a handle to memory that
+processes share, rather than as a copy of their values, so a raster stack
+can be sent to a pool of worker processes and still be in memory only once:
+
+    * SharedArray - an array in shared memory (see share_array)
+    * MappedArray - an array memory mapped from a file (see map_array)
+
+Only the whole array is pickled this way; a slice or view of it is
+pickled as a copy, as any other numpy array.
+"""
+
+# held while resource_tracker.register is swapped out (see _attach)
+_register_lock = threading.Lock()
+
+
+class _PlainResults(object):
+    # anything computed from the array is an ordinary array, so the
+    # values the stack gives back are too
+
+    def __getitem__(self, index):
+        return np.asarray(self)[index]
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(x) if isinstance(x, _PlainResults) else x
+                  for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+
+class SharedArray(_PlainResults, np.ndarray):
+    """
+    A numpy array in a block of shared memory, made by share_array. When
+    pickled, only the name of the block is sent; unpickling attaches to
+    the same memory.
+
+    The process that made the array owns the block, and frees it once the
+    array has been garbage collected (or at exit). Other processes must
+    not use it for longer than that.
+    """
+
+    def __array_finalize__(self, obj):
+        # views and copies are ordinary arrays
+        self._shm = None
+
+    def __reduce__(self):
+        if self._shm is None:
+            return np.ndarray.__reduce__(np.asarray(self))
+        return (_attach, (self._shm.name, self.dtype.str, self.shape))
+
+
+def is_shared(array):
+    """
+    Is an array in memory that other processes can use, i.e. a SharedArray
+    or memory mapped?
+    """
+    return isinstance(array, (SharedArray, np.memmap))
+
+
+def share_array(array):
+    """
+    Copy an array into a new block of shared memory, unless it is shared
+    already (see is_shared).
+
+    Args:
+        array: the numpy array to share
+
+    Returns:
+        a SharedArray with the same values (or the array)
+    """
+    if is_shared(array):
+        return array
+    array = np.asarray(array)
+    with _register_lock:
+        # so the block is registered, even if another thread is attaching
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(array.nbytes, 1))
+    shared = _wrap(shm, array.dtype, array.shape)
+    shared[...] = array
+    shared.flags.writeable = False
+    weakref.finalize(shared, _release, shm, True)
+    return shared
+
+
+def _attach(name, dtype, shape):
+    """
+    Attach to an array shared by another process.
+    """
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13, attaching registers the block with this
+        # process's resource tracker, which would free it when this
+        # process exits, while the owner is still using it. Other threads
+        # mustn't attach while it is swapped out, or they would restore
+        # the wrong one
+        with _register_lock:
+            register = resource_tracker.register
+
+            def no_register(name, rtype):
+                if rtype != "shared_memory":
+                    register(name, rtype)
+
+            resource_tracker.register = no_register
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+    shared = _wrap(shm, dtype, shape)
+    shared.flags.writeable = False
+    weakref.finalize(shared, _release, shm, False)
+    return shared
+
+
+def _wrap(shm, dtype, shape):
+    shared = np.ndarray(shape, dtype=dtype, buffer=shm.buf).view(SharedArray)
+    shared._shm = shm
+    return shared
+
+
+def _release(shm, unlink):
+    try:
+        shm.close()
+    except BufferError:
+        # still in use by a view that outlived the array; the memory is
+        # freed when the process exits
+        return
+    if unlink:
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class MappedArray(_PlainResults, np.memmap):
+    """
+    A read-only numpy array memory mapped from a file, made by map_array.
+    When pickled, only the file name and position are sent; unpickling
+    maps the same file, so processes share it through the page cache.
+    """
+
+    def __array_finalize__(self, obj):
+        np.memmap.__array_finalize__(self, obj)
+        # views and copies are ordinary arrays
+        self._whole = False
+
+    def __reduce__(self):
+        if not self._whole:
+            return np.ndarray.__reduce__(np.array(self))
+        return (map_array, (self.filename, self.dtype.str, self.shape,
+                            self.offset))
+
+
+def map_array(filename, dtype, shape, offset=0):
+    """
+    Memory map an array, read-only, from a file.
+
+    Args:
+        filename: the file
+        dtype: the type of the array
+        shape: the shape of the array, which is in C order
+        offset: where in the file the array starts, in bytes
+
+    Returns:
+        a MappedArray
+    """
+    mapped = np.memmap(filename, dtype=dtype, mode="r", offset=offset,
+                       shape=tuple(shape)).view(MappedArray)
+    mapped._whole = True
+    return mapped
@@ -0,0 +1,466 @@
+import math
+import numpy as np
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+"""
+This module contains indexes over the layers of a raster stack, used by
+HRDS to find which layers a point is in without asking each of them:
+CoverageIndex, a coarse grid of which layer gives the value where, and
+RTree, for finding which layers a point is in. curve_order sorts points
+along a space-filling curve, so those close together are evaluated
+together, and unique_points finds repeated points, so they are only
+evaluated once.
+"""
+
+
+class CoverageIndex():
+    """
+    A coarse grid over the layers of a raster stack, recording for each
+    cell the highest priority layer that any part of the cell is in, and
+    whether that layer alone gives the value everywhere in the cell::
+
+        index = CoverageIndex(raster_stack, buffer_stack)
+        layer, pure = index.lookup([100, 100])
+
+    A layer is "pure" over a cell if the cell is entirely inside it and
+    its buffer is exactly 1 for all of the cell, so the stack value is
+    just that layer's value. A layer of -1 means no layer covers the
+    cell, so the value comes from the base raster. Otherwise the stack
+    must be searched, but from the layer given rather than the top.
+
+    The decisions are conservative: a cell is only pure (or base only)
+    if that is true for every point in it, so using the index never
+    changes the values returned.
+
+    Both stacks are in priority order (highest first) and must have had
+    set_band called.
+    """
+
+    def __init__(self, raster_stack, buffer_stack, size=512, block=16):
+        """
+        Build our index
+
+        Args:
+            raster_stack: the RasterInterpolators of each layer
+            buffer_stack: the RasterInterpolators of their buffers
+            size: the number of cells along the longest side of the index
+            block: the size (in buffer cells) of the blocks each buffer is
+                summarised in. Smaller blocks are more precise, but slower
+                to build
+
+        Returns:
+            a CoverageIndex object
+        """
+        llc = np.amin([r.llc for r in raster_stack], axis=0)
+        urc = np.amax([r.urc for r in raster_stack], axis=0)
+        width = max(urc[0] - llc[0], urc[1] - llc[1])
+        self.cell = width / size if width > 0 else 1.0
+        # a cell of margin all round, so anything off the grid is in
+        # no layer at all
+        self.origin = llc - self.cell
+        self.shape = (int(math.ceil((urc[1] - llc[1]) / self.cell)) + 2,
+                      int(math.ceil((urc[0] - llc[0]) / self.cell)) + 2)
+        # the cells, grown a little to allow for rounding in lookup
+        eps = self.cell * 1e-6
+        xa = self.origin[0] + np.arange(self.shape[1]) * self.cell - eps
+        xb = self.origin[0] + np.arange(1, self.shape[1] + 1) * self.cell + eps
+        ya = (self.origin[1] + np.arange(self.shape[0]) * self.cell -
+              eps)[:, None]
+        yb = (self.origin[1] + np.arange(1, self.shape[0] + 1) * self.cell +
+              eps)[:, None]
+
+        self.layer = np.full(self.shape, -1, dtype=np.int32)
+        self.pure = np.zeros(self.shape, dtype=bool)
+        decided = np.zeros(self.shape, dtype=bool)
+        for k, (r, b) in enumerate(zip(raster_stack, buffer_stack)):
+            touches = ((xb >= r.llc[0]) & (xa <= r.urc[0]) &
+                       (yb >= r.llc[1]) & (ya <= r.urc[1]))
+            new = touches & np.logical_not(decided)
+            if not new.any():
+                continue
+            inside = ((xa >= r.llc[0]) & (xb <= r.urc[0]) &
+                      (ya >= r.llc[1]) & (yb <= r.urc[1]))
+            self.layer[new] = k
+            self.pure[new] = (inside & _all_one(b, xa, xb, ya, yb,
+                                                block))[new]
+            decided |= touches
+
+    @classmethod
+    def from_arrays(cls, layer, pure, origin, cell):
+        """
+        Make a CoverageIndex from the grids of one built before, e.g. one
+        kept by HRDS.save.
+
+        Args:
+            layer, pure: the layer and pure grids
+            origin: the lower left corner of the grid
+            cell: the size of the cells
+
+        Returns:
+            a CoverageIndex object
+        """
+        index = cls.__new__(cls)
+        index.layer = layer
+        index.pure = pure
+        index.origin = np.asarray(origin, dtype=np.float64)
+        index.cell = cell
+        index.shape = layer.shape
+        return index
+
+    def lookup(self, point):
+        """
+        Find the cell a point is in.
+
+        Args:
+            point: a length 2 list containing x,y coordinates
+
+        Returns:
+            a tuple (layer, pure). See CoverageIndex.
+        """
+        ci = (point[1] - self.origin[1]) / self.cell
+        cj = (point[0] - self.origin[0]) / self.cell
+        if not (ci == ci and cj == cj):
+            # NaN, so let the stack deal with it
+            return 0, False
+        if (ci < 0 or cj < 0 or ci >= self.shape[0] or cj >= self.shape[1]):
+            return -1, False
+        ci = int(ci)
+        cj = int(cj)
+        return int(self.layer[ci, cj]), bool(self.pure[ci, cj])
+
+    def lookup_many(self, points):
+        """
+        Find the cells many points are in. Vectorised version of lookup.
+
+        Args:
+            points: an (N, 2) array-like of x,y coordinates
+
+        Returns:
+            a tuple (layer, pure) of length N numpy arrays
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        ci = (points[:, 1] - self.origin[1]) / self.cell
+        cj = (points[:, 0] - self.origin[0]) / self.cell
+        on_grid = ((ci >= 0) & (cj >= 0) &
+                   (ci < self.shape[0]) & (cj < self.shape[1]))
+        layer = np.full(len(points), -1, dtype=np.int32)
+        pure = np.zeros(len(points), dtype=bool)
+        ci = ci[on_grid].astype(np.intp)
+        cj = cj[on_grid].astype(np.intp)
+        layer[on_grid] = self.layer[ci, cj]
+        pure[on_grid] = self.pure[ci, cj]
+        # NaN, so let the stack deal with it
+        nans = np.isnan(points).any(axis=1)
+        layer[nans] = 0
+        return layer, pure
+
+
+class RTree():
+    """
+    A static R-tree over a set of boxes, packed with the Sort-Tile-Recursive
+    algorithm, to find which boxes contain a point in logarithmic time::
+
+        tree = RTree([[0, 0, 10, 10], [5, 5, 20, 20]])
+        tree.query([6, 6])  # array([0, 1])
+
+    The boxes are (xmin, ymin, xmax, ymax) and include their edges. They
+    are sorted into vertical slices by x and then, within each slice, by
+    y, before being packed node_size at a time into leaves; each level
+    above packs consecutive nodes of the one below, which are already
+    close together. The tree cannot be changed once built.
+    """
+
+    def __init__(self, boxes, node_size=16):
+        """
+        Build our tree
+
+        Args:
+            boxes: an (N, 4) array-like of boxes
+            node_size: the number of children of each node
+
+        Returns:
+            an RTree object
+        """
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.node_size = node_size
+        n = len(self.boxes)
+        centre = (self.boxes[:, :2] + self.boxes[:, 2:]) / 2.0
+        order = np.argsort(centre[:, 0], kind='stable')
+        leaves = int(math.ceil(n / node_size))
+        slices = max(int(math.ceil(math.sqrt(leaves))), 1)
+        per_slice = max(int(math.ceil(leaves / slices)), 1) * node_size
+        for s in range(0, n, per_slice):
+            part = order[s:s + per_slice]
+            order[s:s + per_slice] = part[np.argsort(centre[part, 1],
+                                                     kind='stable')]
+        # the item at each position of the bottom level
+        self.order = order
+        # the boxes of each level, from the items up to the root
+        self.levels = [self.boxes[order]]
+        while len(self.levels[-1]) > 1:
+            below = self.levels[-1]
+            starts = np.arange(0, len(below), node_size)
+            self.levels.append(np.column_stack((
+                np.minimum.reduceat(below[:, 0], starts),
+                np.minimum.reduceat(below[:, 1], starts),
+                np.maximum.reduceat(below[:, 2], starts),
+                np.maximum.reduceat(below[:, 3], starts))))
+
+    def query(self, point):
+        """
+        Find the boxes containing a point.
+
+        Args:
+            point: a length 2 list containing x,y coordinates
+
+        Returns:
+            a numpy array of the indices of the boxes, in ascending order
+        """
+        nodes = np.arange(len(self.levels[-1]))
+        for level in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[level][nodes]
+            nodes = nodes[(point[0] >= boxes[:, 0]) &
+                          (point[0] <= boxes[:, 2]) &
+                          (point[1] >= boxes[:, 1]) &
+                          (point[1] <= boxes[:, 3])]
+            if level > 0:
+                nodes = self._children(nodes, level)[1]
+        return np.sort(self.order[nodes])
+
+    def query_many(self, points, chunk_size=16384):
+        """
+        Find the boxes containing many points. Vectorised version of
+        query; the points descend the tree together, chunk_size at a
+        time, so the memory used is bounded however many points there
+        are.
+
+        Args:
+            points: an (N, 2) array-like of x,y coordinates
+            chunk_size: the number of points to descend at a time
+
+        Returns:
+            a tuple (point, box) of numpy arrays, with a pair of entries
+            for each box a point is in. They are sorted by point, then by
+            box.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        found = [self._query_chunk(points[s:s + chunk_size], s)
+                 for s in range(0, len(points), chunk_size)]
+        if len(found) == 0:
+            return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+        return (np.concatenate([f[0] for f in found]),
+                np.concatenate([f[1] for f in found]))
+
+    def _query_chunk(self, points, start):
+        # query_many for one chunk of points, numbered from start
+        top = len(self.levels[-1])
+        pts = np.repeat(np.arange(len(points)), top)
+        nodes = np.tile(np.arange(top), len(points))
+        for level in range(len(self.levels) - 1, -1, -1):
+            boxes = self.levels[level][nodes]
+            x = points[pts, 0]
+            y = points[pts, 1]
+            keep = ((x >= boxes[:, 0]) & (x <= boxes[:, 2]) &
+                    (y >= boxes[:, 1]) & (y <= boxes[:, 3]))
+            pts = pts[keep]
+            nodes = nodes[keep]
+            if level > 0:
+                counts, nodes = self._children(nodes, level)
+                pts = np.repeat(pts, counts)
+        items = self.order[nodes]
+        order = np.lexsort((items, pts))
+        return pts[order] + start, items[order]
+
+    def _children(self, nodes, level):
+        # the nodes on the level below, and how many each node has
+        size = len(self.levels[level - 1])
+        first = nodes * self.node_size
+        counts = np.minimum(first + self.node_size, size) - first
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) -
+                                                      counts, counts)
+        return counts, np.repeat(first, counts) + offsets
+
+
+def curve_order(points, box, curve="hilbert", bits=16):
+    """
+    Sort points along a space-filling curve over a box::
+
+        order = curve_order(points, [0, 0, 1000, 1000])
+        sorted_points = points[order]
+
+    The box is divided into a 2**bits by 2**bits grid and the cells are
+    visited in the order of a Hilbert or Morton (Z-order) curve. Points
+    that are close together are then (mostly) close together in the
+    order, so evaluating the points in that order reads each part of a
+    raster, or each block of a lazy one, about once, rather than jumping
+    about it. The Hilbert curve has no long jumps, so keeps more points
+    together than Morton, which is a little quicker to work out.
+
+    Points outside the box are put in the cell on the edge nearest to
+    them, and any with NaN coordinates go last.
+
+    Args:
+        points: an (N, 2) array-like of x,y coordinates
+        box: the region (xmin, ymin, xmax, ymax) to put the curve over,
+            usually the extent of the rasters
+        curve: "hilbert" or "morton"
+        bits: the number of bits in each cell coordinate, at most 32
+
+    Returns:
+        a length N numpy array, the order of the points along the curve
+
+    Raises:
+        ValueError: The curve is not known
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n = 2 ** bits
+    cells = []
+    for axis in (0, 1):
+        width = box[axis + 2] - box[axis]
+        scale = n / width if width > 0 else 0.0
+        c = np.nan_to_num((points[:, axis] - box[axis]) * scale)
+        cells.append(np.clip(c, 0, n - 1).astype(np.uint64))
+    if curve == "hilbert":
+        keys = _hilbert_keys(cells[0], cells[1], bits)
+    elif curve == "morton":
+        keys = _spread_bits(cells[0]) | (_spread_bits(cells[1]) << 1)
+    else:
+        raise ValueError("Unknown space-filling curve: " + str(curve))
+    keys[np.isnan(points).any(axis=1)] = np.iinfo(np.uint64).max
+    return np.argsort(keys, kind='stable')
+
+
+def unique_points(points, tolerance=None):
+    """
+    Find the distinct points in a set with repeats, such as the nodes of a
+    discontinuous or vector function space::
+
+        index, inverse = unique_points(points)
+        vals = evaluate(points[index])[inverse]
+
+    Args:
+        points: an (N, 2) array-like of x,y coordinates
+        tolerance: treat points as the same if they are in the same
+            square of this size (on a grid from 0, 0), rather than only if
+            they are exactly the same. Default is None (exactly).
+
+    Returns:
+        a tuple (index, inverse) of numpy arrays: the index of the first
+        of each distinct point, and which of those each point is
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if tolerance:
+        keys = np.floor(points / tolerance)
+    else:
+        # each x,y pair as one number, which is quicker to sort
+        keys = np.ascontiguousarray(points)
+    keys = keys.view(np.complex128).ravel()
+    unique, index, inverse = np.unique(keys, return_index=True,
+                                       return_inverse=True)
+    return index, inverse.ravel()
+
+
+def _spread_bits(v):
+    """
+    Put a zero bit between each of the (lower 32) bits of each value, to
+    be interleaved with another to give a Morton key.
+    """
+    v = v & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def _hilbert_keys(x, y, bits):
+    """
+    The distance along a Hilbert curve over a 2**bits square grid of each
+    cell (x, y), as the classic xy2d, for many cells at once.
+    """
+    n1 = np.uint64(2 ** bits - 1)
+    d = np.zeros(len(x), dtype=np.uint64)
+    s = np.uint64(2 ** (bits - 1))
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((np.uint64(3) * rx) ^ ry)
+        # rotate the quadrant, so the curve joins up
+        flip = rx & np.logical_not(ry)
+        fx = np.where(flip, n1 - x, x)
+        fy = np.where(flip, n1 - y, y)
+        x = np.where(ry, fx, fy)
+        y = np.where(ry, fy, fx)
+        s //= np.uint64(2)
+    return d
+
+
+def _all_one(buffer, xa, xb, ya, yb, block):
+    """
+    Is the buffer exactly 1 for the whole of each cell? Every buffer value
+    used to interpolate at any point in the cell must be 1 (then so is the
+    interpolated value) and within the buffer.
+    """
+    interp = buffer.interpolator
+    shape = interp.val.shape
+
+    def support(a, b, axis):
+        # the range of buffer rows or columns used between a and b
+        d = interp.delta[axis]
+        o = interp.origin[axis]
+        lo = np.floor((a + d/2.0 - o) / d).astype(np.int64) - 1
+        hi = np.floor((b + d/2.0 - o) / d).astype(np.int64)
+        return lo, hi
+
+    jlo, jhi = support(xa, xb, 0)
+    ilo, ihi = support(ya, yb, 1)
+    in_range = ((ilo >= 0) & (ihi < shape[0]) & (jlo >= 0) & (jhi < shape[1]))
+    not_one = _block_any(interp.val, block)
+    # summed area table of blocks with a value other than one
+    table = np.zeros((not_one.shape[0] + 1, not_one.shape[1] + 1),
+                     dtype=np.int64)
+    table[1:, 1:] = np.cumsum(np.cumsum(not_one, axis=0), axis=1)
+    bi0 = np.clip(ilo, 0, shape[0] - 1) // block
+    bi1 = np.clip(ihi, 0, shape[0] - 1) // block + 1
+    bj0 = np.clip(jlo, 0, shape[1] - 1) // block
+    bj1 = np.clip(jhi, 0, shape[1] - 1) // block + 1
+    count = (table[bi1, bj1] - table[bi0, bj1] - table[bi1, bj0] +
+             table[bi0, bj0])
+    return in_range & (count == 0)
+
+
+def _block_any(val, block):
+    """
+    Which blocks of an array (or TiledBand) have a value other than one?
+    The array is read a strip of blocks at a time.
+    """
+    ny, nx = val.shape
+    nbi = int(math.ceil(ny / block))
+    nbj = int(math.ceil(nx / block))
+    out = np.zeros((nbi, nbj), dtype=bool)
+    strip = np.zeros((block, nbj * block), dtype=bool)
+    for bi in range(nbi):
+        i0 = bi * block
+        i1 = min(i0 + block, ny)
+        if hasattr(val, "read"):
+            data = val.read(i0, i1)
+        else:
+            data = val[i0:i1]
+        strip[:] = False
+        strip[:i1 - i0, :nx] = data != 1.0
+        out[bi] = strip.reshape(block, nbj, block).any(axis=(0, 2))
+    return out
@@ -0,0 +1,125 @@
+import json
+import struct
+import numpy as np
+from .shared import map_array
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+"""
+This module reads and writes the single file store that HRDS.save keeps a
+raster stack in. The file is::
+
+    8 bytes     b"HRDSSTK1"
+    8 bytes     the length of the header (little endian)
+    header      JSON, describing the stack and each array in it
+    arrays      each one contiguous, in C order, starting on a page
+                boundary
+
+Each array is read as a memory map, so opening a store reads only the
+header, and the operating system reads in (and shares between processes)
+just the pages of the arrays that are used.
+"""
+
+MAGIC = b"HRDSSTK1"
+# arrays start on a page boundary
+ALIGN = 4096
+
+
+class StoreError(Exception):
+    """
+    Raised when a file is not a store, or is damaged
+    """
+
+    pass
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def write_store(path, header, arrays, rows=1024):
+    """
+    Write a store.
+
+    Args:
+        path: the file to write
+        header: a dictionary of anything that can be saved as JSON
+        arrays: a dictionary of name to array. Each can be a numpy array
+            or anything with shape and dtype attributes and a read(i0, i1)
+            method giving rows i0 to i1 (such as a TiledBand).
+        rows: the number of rows written at a time
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"offset": offset,
+                        "dtype": np.dtype(array.dtype).str,
+                        "shape": [int(n) for n in array.shape]}
+        offset = _aligned(offset + np.dtype(array.dtype).itemsize *
+                          int(np.prod(array.shape)))
+    header = dict(header, arrays=layout)
+    text = json.dumps(header).encode("utf-8")
+    start = _aligned(len(MAGIC) + 8 + len(text))
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(text)))
+        f.write(text)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]["offset"])
+            dtype = np.dtype(layout[name]["dtype"])
+            for i in range(0, max(array.shape[0], 1), rows):
+                if hasattr(array, "read"):
+                    data = array.read(i, min(i + rows, array.shape[0]))
+                else:
+                    data = array[i:i+rows]
+                f.write(np.ascontiguousarray(data, dtype=dtype).tobytes())
+        # the file must reach the end of the last array, even if empty
+        f.truncate(start + offset)
+
+
+def read_store(path):
+    """
+    Open a store.
+
+    Args:
+        path: the file to read
+
+    Returns:
+        A tuple of the header (with the layout of the arrays under
+        "arrays") and a dictionary of name to MappedArray
+
+    Raises:
+        StoreError: The file is not a store
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise StoreError(str(path) + " is not an HRDS store")
+        size = struct.unpack("<Q", f.read(8))[0]
+        try:
+            header = json.loads(f.read(size).decode("utf-8"))
+        except ValueError:
+            raise StoreError("The header of " + str(path) + " is damaged")
+    start = _aligned(len(MAGIC) + 8 + size)
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        shape = tuple(layout["shape"])
+        if np.prod(shape) == 0:
+            # can't memory map nothing
+            arrays[name] = np.zeros(shape, dtype=layout["dtype"])
+            continue
+        arrays[name] = map_array(path, layout["dtype"], shape,
+                                 start + layout["offset"])
+    return header, arrays
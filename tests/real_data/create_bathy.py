@@ -7,15 +7,14 @@ mesh2d = firedrake.Mesh('test_mesh.msh') # mesh file
 P1_2d = firedrake.FunctionSpace(mesh2d, 'CG', 1)
 bathymetry2d = firedrake.Function(P1_2d, name="bathymetry")
 bvector = bathymetry2d.dat.data
-bathy = HRDS("gebco_uk.tif", 
-             rasters=("emod_utm.tif", 
-                      "inspire_data.tif"), 
-             distances=(700, 200))
+# the coordinates of this rank's part of the mesh (all of it in serial), so
+# under MPI each rank only reads the rasters around its own partition
+coords = mesh2d.coordinates.dat.data_ro
+bathy = HRDS("gebco_uk.tif",
+             rasters=("emod_utm.tif",
+                      "inspire_data.tif"),
+             distances=(700, 200),
+             roi=coords, halo=1000)
 bathy.set_bands()
-for i, (xy) in enumerate(mesh2d.coordinates.dat.data):
-    bvector[i] = bathy.get_val(xy)
+bvector[:] = bathy.get_vals(coords)
 thetis.File('bathy.pvd').write(bathymetry2d)
-
-
-
-
@@ -5,6 +5,7 @@ import sys
 sys.path.insert(0,os.path.dirname(os.path.realpath(__file__))+'/..')
 from hrds.raster_buffer import CreateBuffer
 from hrds.raster import RasterInterpolator, CoordinateError, RasterInterpolatorError
+from numpy import array_equal, zeros
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -125,6 +126,101 @@ class TestBufferCreator(unittest.TestCase):
         self.assertAlmostEqual(rci.get_val(point2), 0.2, delta=0.03)
         self.assertEqual(rci.get_val(point3), 0.0)
 
+    def test_in_memory(self):
+        """ Keep the buffer in memory, rather than writing it to file.
+            The values should be the same as those read from the file.
+            """
+        rbuff = CreateBuffer(test_file_name2, 0.5)
+        rbuff.make_buffer(temp_file)
+        rci = RasterInterpolator(temp_file)
+        rci.set_band()
+        mem = RasterInterpolator(rbuff.make_buffer())
+        mem.set_band()
+        self.assertTrue(array_equal(mem.get_array(), rci.get_array()))
+        self.assertEqual(mem.get_extent(), rci.get_extent())
+        self.assertEqual(mem.get_val([0.8, 2]), rci.get_val([0.8, 2]))
+
+    def test_narrow_band(self):
+        """ The narrow band buffer, split into small blocks so that some
+            are skipped, must be identical to the distance transform
+            over the whole raster.
+            """
+        full = CreateBuffer(test_file_name2, 0.5, narrow_band=False)
+        dx, nx, ny = full.get_grid()
+        narrow = CreateBuffer(test_file_name2, 0.5, block_size=1)
+        self.assertTrue(array_equal(narrow.get_buffer(0, ny, 0, nx),
+                                    full.get_buffer(0, ny, 0, nx)))
+
+    def test_tiled(self):
+        """ Create the buffer in 7x7 tiles, in this process and on a pool
+            of two, and check it is identical to the buffer made in
+            one go.
+            """
+        rbuff = CreateBuffer(test_file_name2, 0.5)
+        rbuff.make_buffer(temp_file)
+        rci = RasterInterpolator(temp_file)
+        rci.set_band()
+        tiled = CreateBuffer(test_file_name2, 0.5, tile_size=7)
+        for workers in (None, 2):
+            tiled.make_buffer(temp_file, workers=workers)
+            tiled_rci = RasterInterpolator(temp_file)
+            tiled_rci.set_band()
+            self.assertTrue(array_equal(tiled_rci.get_array(),
+                                        rci.get_array()))
+            self.assertEqual(tiled_rci.get_extent(), rci.get_extent())
+
+    def test_extend_mask(self):
+        """ Extending a mask by three cells in one go should be the same
+            as extending it one cell three times. Dilating by a distance
+            grows the mask by a circle.
+            """
+        rbuff = CreateBuffer(test_file_name1, 1.5)
+        mask = zeros((15, 15), dtype=bool)
+        mask[7, 7] = True
+        once = rbuff.extend_mask(mask, 1)
+        self.assertEqual(once.sum(), 9)
+        self.assertTrue(array_equal(rbuff.extend_mask(mask, 3),
+                        rbuff.extend_mask(rbuff.extend_mask(once, 1), 1)))
+        self.assertEqual(rbuff.extend_mask(mask, 3).sum(), 49)
+        circle = rbuff.dilate(mask, 1.0, [0.5, 0.5])
+        self.assertEqual(circle.sum(), 13)
+        self.assertTrue(circle[7, 5])
+        self.assertFalse(circle[6, 5])
+
+    def test_expand(self):
+        """ Expand the NaNs in the centre of the raster by 0.4, rather
+            than a single cell (0.2). The buffer should now be zero
+            further from the NaNs, and the same whether tiled or not, and
+            whether the tiles are made in this process or others.
+            """
+        point = [0.8, 2]  # 0.2 with the default expansion
+        rbuff = CreateBuffer(test_file_name2, 0.5, expand=0.4)
+        rbuff.make_buffer(temp_file)
+        rci = RasterInterpolator(temp_file)
+        rci.set_band()
+        self.assertLess(rci.get_val(point), 0.2)
+        tiled = CreateBuffer(test_file_name2, 0.5, expand=0.4, tile_size=6)
+        for workers in (None, 2):
+            tiled.make_buffer(temp_file, workers=workers)
+            tiled_rci = RasterInterpolator(temp_file)
+            tiled_rci.set_band()
+            self.assertTrue(array_equal(tiled_rci.get_array(),
+                                        rci.get_array()))
+
+    def test_bbox(self):
+        """ Create the buffer over only part of the raster with NaNs in
+            the centre. The values must be identical to those in the
+            same part of the buffer made from the whole raster
+            """
+        full = CreateBuffer(test_file_name2, 0.5)
+        dx, nx, ny = full.get_grid()
+        full_buffer = full.get_buffer(0, ny, 0, nx)
+        rbuff = CreateBuffer(test_file_name2, 0.5, bbox=[0.1, 1.0, 1.3, 3.0])
+        r0, r1, c0, c1 = rbuff.get_window(rbuff.bbox, dx, nx, ny)
+        self.assertLess((r1 - r0) * (c1 - c0), nx * ny)
+        self.assertTrue(array_equal(rbuff.get_buffer(r0, r1, c0, c1),
+                                    full_buffer[r0:r1, c0:c1]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import os
+import sys
+import tempfile
+import time
+# make sure we use the devel version first
+sys.path.insert(0,os.path.dirname(os.path.realpath(__file__))+'/..')
+from hrds.cache import DiskCache, make_key
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+
+def write_bytes(n):
+    def writer(filename):
+        with open(filename, "wb") as f:
+            f.write(b"x" * n)
+    return writer
+
+
+class TestDiskCache(unittest.TestCase):
+    """Tests the hrds.cache.DiskCache class"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_put(self):
+        """ Entries can be written and found again, under different keys
+            for different content.
+        """
+        cache = DiskCache(self.tmpdir.name)
+        key = make_key("buffer", "a.tif", 1, 500.0)
+        self.assertNotEqual(key, make_key("buffer", "a.tif", 1, 400.0))
+        self.assertIsNone(cache.get(key, ".tif"))
+        filename = cache.put(key, ".tif", write_bytes(10))
+        self.assertEqual(cache.get(key, ".tif"), filename)
+        self.assertEqual(os.path.getsize(filename), 10)
+        # no temporary files left lying about
+        self.assertEqual(os.listdir(self.tmpdir.name), [key + ".tif"])
+
+    def test_eviction(self):
+        """ With a limit of 25 bytes, only two 10 byte entries fit. The
+            least recently used one should go.
+        """
+        cache = DiskCache(self.tmpdir.name, max_bytes=25)
+        keys = [make_key(i) for i in range(3)]
+        cache.put(keys[0], ".tif", write_bytes(10))
+        cache.put(keys[1], ".tif", write_bytes(10))
+        # use the first entry again, so the second is the oldest
+        past = time.time() - 100
+        os.utime(cache.filename(keys[1], ".tif"), (past, past))
+        cache.get(keys[0], ".tif")
+        cache.put(keys[2], ".tif", write_bytes(10))
+        self.assertIsNotNone(cache.get(keys[0], ".tif"))
+        self.assertIsNone(cache.get(keys[1], ".tif"))
+        self.assertIsNotNone(cache.get(keys[2], ".tif"))
+
+    def test_signature(self):
+        """ The signature of a file changes when the file does """
+        cache = DiskCache(self.tmpdir.name, hash_content=True)
+        filename = os.path.join(self.tmpdir.name, "raster.tif")
+        write_bytes(10)(filename)
+        sig = cache.signature(filename)
+        write_bytes(11)(filename)
+        self.assertNotEqual(sig, cache.signature(filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
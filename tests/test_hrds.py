@@ -3,8 +3,19 @@ import os
 import sys
 # make sure we use the devel version first
 sys.path.insert(0,os.path.dirname(os.path.realpath(__file__))+'/..')
-from hrds.hrds import HRDS
+from hrds.hrds import HRDS, HRDSError
+from hrds.cache import DiskCache
+from hrds.raster import CoordinateError, RasterInterpolator
+from hrds.raster import ArrayDataset, QuantizedBand
+import numpy as np
 import os
+import gc
+import hrds.hrds
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+from osgeo import gdal
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -30,6 +41,75 @@ layer1 = os.path.join(test_dir, "layer1.tif")
 layer2 = os.path.join(test_dir, "layer2.tif")
 
 
+def split_raster(filename, directory, size):
+    """ Split a raster into tiles of size x size cells """
+    ds = gdal.Open(filename)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    gt = ds.GetGeoTransform()
+    tiles = []
+    for i in range(0, data.shape[0], size):
+        for j in range(0, data.shape[1], size):
+            tile = os.path.join(directory, "tile_{}_{}.tif".format(i, j))
+            block = data[i:i+size, j:j+size]
+            out = gdal.GetDriverByName('GTiff').Create(
+                tile, block.shape[1], block.shape[0], 1, gdal.GDT_Float32)
+            out.SetGeoTransform((gt[0]+j*gt[1], gt[1], 0,
+                                 gt[3]+i*gt[5], 0, gt[5]))
+            out.GetRasterBand(1).WriteArray(block)
+            out.FlushCache()
+            out = None
+            tiles.append(tile)
+    return tiles
+
+
+def three_layer_stack(**options):
+    """ The base and both layers, ready to use """
+    bathy = HRDS(base_raster, rasters=(layer1, layer2), distances=(7, 5),
+                 **options)
+    bathy.set_bands()
+    return bathy
+
+
+def grid_points():
+    """ A grid of points over the whole stack, away from its edges """
+    x, y = np.meshgrid(np.linspace(2, 97, 83), np.linspace(2, 97, 77))
+    return np.column_stack((x.ravel(), y.ravel()))
+
+
+def write_raster(filename, data, origin, dx):
+    """ Write an array to a raster, with its top left corner at origin """
+    out = gdal.GetDriverByName('GTiff').Create(
+        filename, data.shape[1], data.shape[0], 1, gdal.GDT_Float32)
+    out.SetGeoTransform((origin[0], dx, 0, origin[1], 0, -dx))
+    out.GetRasterBand(1).WriteArray(data)
+    out.FlushCache()
+    out = None
+
+
+def sample(bathy, points):
+    """ Sample a stack in a worker process """
+    return bathy.get_vals(points)
+
+
+def sample_partition(points):
+    """ Sample a stack of only the part of the rasters around some points,
+        as an MPI rank would, and count the cells read.
+    """
+    bathy = HRDS(base_raster, rasters=(layer1, layer2), distances=(7, 5),
+                 roi=points, halo=2)
+    bathy.set_bands()
+    cells = sum(r.get_array().size for r in
+                [bathy.baseRaster] + bathy.raster_stack + bathy.buffer_stack)
+    return bathy.get_vals(points), cells
+
+
+def sample_shared(node_dir, points):
+    """ Sample the stack shared on the node in a worker process """
+    bathy = HRDS(base_raster, rasters=(layer1, layer2), distances=(7, 5),
+                 node_share=node_dir)
+    return bathy.get_vals(points)
+
+
 class TestHRDS(unittest.TestCase):
     """Tests the hrds.hrds.HRDS class"""
 
@@ -80,6 +160,426 @@ class TestHRDS(unittest.TestCase):
         os.remove(os.path.join(test_dir, "layer1_buffer.tif"))
         os.remove(os.path.join(test_dir, "layer2_buffer.tif"))
 
+    def test_batch_matches_scalar(self):
+        """ Same three layer test as above, but we ask for a grid of points
+            across the whole stack in one go and check the answers are
+            identical to those of get_val.
+        """
+        bathy = three_layer_stack()
+        points = grid_points()
+        vals = bathy.get_vals(points)
+        expected = [bathy.get_val(p) for p in points]
+        self.assertTrue(np.array_equal(vals, expected))
+        self.assertRaises(CoordinateError, bathy.get_vals, [[5, 5], [-10, 5]])
+
+    def test_coverage_index(self):
+        """ The coverage index should send points in the middle of layer 2
+            straight to it, and those away from both layers to the base,
+            without changing any of the values.
+        """
+        bathy = three_layer_stack()
+        # layer 2 is the highest priority, so first in the stack
+        self.assertEqual(bathy.index.lookup([42, 47]), (0, True))
+        self.assertEqual(bathy.index.lookup([31, 40]), (0, False))
+        self.assertEqual(bathy.index.lookup([90, 90])[0], -1)
+        self.assertEqual(bathy.index.lookup([5, 5])[0], -1)
+        no_index = three_layer_stack(index_size=None)
+        self.assertIsNone(no_index.index)
+        points = grid_points()
+        self.assertTrue(np.array_equal(bathy.get_vals(points),
+                                       no_index.get_vals(points)))
+        for p in points[::37]:
+            self.assertEqual(bathy.get_val(p), no_index.get_val(p))
+
+    def test_lazy_open(self):
+        """ Split layer 1 into six tiles and use them as the stack. With
+            lazy_open, only the tiles (and their buffers) that queries touch
+            are read, and the values are the same as reading them all.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tiles = split_raster(layer1, tmpdir, 50)
+            bathy = HRDS(base_raster, rasters=tiles, distances=[2]*6)
+            bathy.set_bands()
+            lazy = HRDS(base_raster, rasters=tiles, distances=[2]*6,
+                        lazy_open=True)
+            lazy.set_bands()
+            self.assertFalse(any(lazy.opened))
+            # the tiles are closed until needed
+            self.assertTrue(all(r._ds is None for r in lazy.raster_stack))
+            self.assertIsNone(lazy.index)
+            # the middle of the bottom left tile, well away from its edges
+            point = [20, 20]
+            self.assertEqual(list(lazy.tree.query(point)), [1])
+            self.assertEqual(lazy.get_val(point), bathy.get_val(point))
+            self.assertEqual(lazy.opened, [False, True, False, False,
+                                           False, False])
+            self.assertIsNone(lazy.buffer_stack[0])
+            self.assertEqual([r._ds is not None for r in lazy.raster_stack],
+                             lazy.opened)
+            points = grid_points()
+            self.assertTrue(np.array_equal(lazy.get_vals(points),
+                                           bathy.get_vals(points)))
+            self.assertTrue(all(lazy.opened))
+
+    def test_mosaic(self):
+        """ Split layer 1 into tiles, and use the directory of tiles as a
+            layer. As the tiles are joined into one raster, with one buffer,
+            the values are the same as using layer 1 itself.
+        """
+        bathy = three_layer_stack()
+        points = grid_points()
+        expected = bathy.get_vals(points)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tiles = split_raster(layer1, tmpdir, 40)
+            for source in (tmpdir, os.path.join(tmpdir, "*.tif"), tiles):
+                mosaic = HRDS(base_raster, rasters=(source, layer2),
+                              distances=(7, 5))
+                mosaic.set_bands()
+                self.assertEqual(len(mosaic.raster_stack), 2)
+                self.assertEqual(mosaic.raster_stack[1].get_extent(),
+                                 bathy.raster_stack[1].get_extent())
+                self.assertTrue(np.array_equal(mosaic.get_vals(points),
+                                               expected))
+
+    def test_quantized(self):
+        """ The three layer stack with rasters stored as 16 bit integers
+            and buffers as bytes should be close to the original, and
+            still give exactly the layer values where the buffers are 1.
+        """
+        bathy = three_layer_stack()
+        quantized = three_layer_stack(quantize=True)
+        self.assertEqual(quantized.buffer_stack[0].val.codes.dtype, np.uint8)
+        # the buffers are only kept as their codes, not the float dataset
+        # they were made in as well
+        buffer_ds = quantized.buffer_stack[0].ds
+        self.assertIsInstance(buffer_ds, ArrayDataset)
+        self.assertIsInstance(buffer_ds.band.val, QuantizedBand)
+        points = grid_points()
+        self.assertTrue(np.allclose(quantized.get_vals(points),
+                                    bathy.get_vals(points), atol=0.01))
+        self.assertEqual(quantized.buffer_stack[0].get_val([42, 47]), 1.0)
+        self.assertEqual(quantized.index.lookup([42, 47]), (0, True))
+
+    def test_region_of_interest(self):
+        """ As above, but only reading the rasters within a region of
+            interest around layer 2. The values should be the same, but
+            much less of the base raster is read.
+        """
+        bathy = three_layer_stack()
+        roi = [[28, 32], [40, 50], [32.5, 45]]
+        cropped = three_layer_stack(roi=roi)
+        self.assertEqual(cropped.bbox, [28, 32, 40, 50])
+        self.assertLess(cropped.baseRaster.get_array().size,
+                        bathy.baseRaster.get_array().size)
+        x, y = np.meshgrid(np.linspace(28, 40, 25), np.linspace(32, 50, 25))
+        points = np.column_stack((x.ravel(), y.ravel()))
+        self.assertTrue(np.allclose(cropped.get_vals(points),
+                                    bathy.get_vals(points)))
+
+    def test_partitions(self):
+        """ Split the points into four strips, as an MPI partitioned mesh
+            would be, and sample each on its own process with a stack of
+            just its strip (plus a halo). The values should be the same as
+            from the whole stack (to rounding, as the windows start in
+            different places), which reads more cells than any strip.
+            A strip with no points gets an all but empty stack.
+        """
+        bathy = three_layer_stack()
+        points = grid_points()
+        cells = sum(r.get_array().size for r in
+                    [bathy.baseRaster] + bathy.raster_stack +
+                    bathy.buffer_stack)
+        parts = [points[(points[:, 0] >= x0) & (points[:, 0] < x0 + 25)]
+                 for x0 in (0, 25, 50, 75)]
+        with ProcessPoolExecutor(2) as pool:
+            results = list(pool.map(sample_partition, parts))
+        for part, (vals, part_cells) in zip(parts, results):
+            self.assertTrue(np.allclose(vals, bathy.get_vals(part)))
+            self.assertLess(part_cells, cells)
+        self.assertEqual(HRDS(base_raster, roi=[10, 20, 30, 40],
+                              halo=5).bbox, [5, 15, 35, 45])
+        # a rank with none of the points reads almost nothing
+        empty = HRDS(base_raster, rasters=(layer1, layer2), distances=(7, 5),
+                     roi=np.zeros((0, 2)), halo=2)
+        empty.set_bands()
+        self.assertEqual(empty.raster_stack, [])
+        self.assertLessEqual(empty.baseRaster.get_array().size, 9)
+        self.assertEqual(len(empty.get_vals(np.zeros((0, 2)))), 0)
+
+    def test_buffer_cache(self):
+        """ Buffers are kept in a cache and reused the second time
+            round, giving the same answers.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            bathy = three_layer_stack(buffer_cache=cache_dir)
+            cached = sorted(os.listdir(cache_dir))
+            self.assertEqual(len(cached), 2)
+            again = three_layer_stack(buffer_cache=cache_dir)
+            self.assertEqual(sorted(os.listdir(cache_dir)), cached)
+            self.assertEqual(bathy.get_val([32.5, 45]), again.get_val([32.5, 45]))
+            # a different distance is a different buffer
+            other = HRDS(base_raster, rasters=(layer1, layer2),
+                         distances=(7, 4), buffer_cache=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            del bathy, again, other
+
+    def test_result_cache(self):
+        """ The values for a set of points are kept and loaded the
+            second time round, unless the points or the stack change.
+            Old results are removed when the cache is full.
+        """
+        points = np.random.RandomState(7).uniform(5, 95, (1000, 2))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            bathy = three_layer_stack(result_cache=cache_dir)
+            vals = bathy.get_vals(points)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            again = three_layer_stack(result_cache=cache_dir)
+            cached = again.get_vals(points)
+            self.assertIsInstance(cached, np.memmap)
+            self.assertTrue(np.array_equal(cached, vals))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # changing the values doesn't change the cache
+            cached[:] = 0
+            self.assertTrue(np.array_equal(again.get_vals(points), vals))
+            # different points, or a different stack, are new results
+            bathy.get_vals(points[:500])
+            other = HRDS(base_raster, rasters=(layer1, layer2),
+                         distances=(7, 4), result_cache=cache_dir)
+            other.set_bands()
+            other.get_vals(points)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            # the same fill value, however it is given, is the same result
+            for fill in (-1, -1.0, np.float64(-1.0)):
+                bathy.get_vals(points, fill=fill)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+            # a cached result was not deduplicated
+            again.get_vals(points[:10], dedup=True)
+            self.assertIsNotNone(again.dedup_report)
+            again.get_vals(points, dedup=True)
+            self.assertIsNone(again.dedup_report)
+            # but a tolerance of 1 (not True) is a different result
+            coarse = again.get_vals(points, dedup=1)
+            self.assertIsNotNone(again.dedup_report)
+            self.assertFalse(np.array_equal(coarse, vals))
+            # a result removed by another process is evaluated again
+            missing = os.path.join(cache_dir, "evicted.npy")
+            again.result_cache.get = lambda key, suffix: missing
+            self.assertTrue(np.array_equal(again.get_vals(points), vals))
+            del cached
+            # room for one set of results only
+            small = three_layer_stack(
+                result_cache=DiskCache(cache_dir, max_bytes=5000))
+            small.get_vals(points[:100])
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_workers(self):
+        """ Building the buffers and reading the rasters on a pool of
+            threads gives the same answers.
+        """
+        bathy = three_layer_stack()
+        threaded = three_layer_stack(workers=3)
+        points = ([5, 5], [40, 50], [28, 32], [13.5, 20], [32.5, 45])
+        self.assertTrue(np.array_equal(threaded.get_vals(points),
+                                       bathy.get_vals(points)))
+
+    def test_get_vals_workers(self):
+        """ Sharing the points between threads or processes, in small
+            chunks, gives the same values in the same order.
+        """
+        bathy = three_layer_stack(lazy=True)
+        points = np.random.RandomState(1).uniform(0, 100, (5000, 2))
+        expected = bathy.get_vals(points, fill=-1.0)
+        # the stack must be shared with the processes first
+        self.assertRaises(HRDSError, bathy.get_vals, points, workers=3,
+                          processes=True)
+        bathy.share()
+        for processes in (False, True):
+            vals = bathy.get_vals(points, fill=-1.0, workers=3,
+                                  chunk_size=700, processes=processes)
+            self.assertTrue(np.array_equal(vals, expected))
+        self.assertRaises(CoordinateError, bathy.get_vals, points,
+                          workers=2, chunk_size=700)
+
+    def test_get_vals_order(self):
+        """ Evaluating the points along a space-filling curve, on its
+            own or with workers, gives the same values in the caller's
+            order.
+        """
+        bathy = three_layer_stack()
+        points = np.random.RandomState(4).uniform(0, 100, (5000, 2))
+        expected = bathy.get_vals(points, fill=-1.0)
+        for order in ("hilbert", "morton"):
+            self.assertTrue(np.array_equal(
+                bathy.get_vals(points, fill=-1.0, order=order), expected))
+            self.assertTrue(np.array_equal(
+                bathy.get_vals(points, fill=-1.0, order=order, workers=2,
+                               chunk_size=900), expected))
+
+    def test_node_share(self):
+        """ The first stack made with node_share is saved to the shared
+            directory, and the rest (in this and other processes) use it,
+            giving the same values. It is removed, with its lock files,
+            when the last one is finished with.
+        """
+        bathy = three_layer_stack()
+        points = np.random.RandomState(2).uniform(5, 95, (1000, 2))
+        expected = bathy.get_vals(points)
+        with tempfile.TemporaryDirectory() as node_dir:
+            def stacks():
+                return [f for f in os.listdir(node_dir) if f.endswith(".hrds")]
+
+            first = three_layer_stack(node_share=node_dir)
+            self.assertEqual(len(stacks()), 1)
+            second = HRDS(base_raster, rasters=(layer1, layer2),
+                          distances=(7, 5), node_share=node_dir)
+            self.assertIsInstance(second.baseRaster.val, np.memmap)
+            self.assertTrue(np.array_equal(second.get_vals(points), expected))
+            with ProcessPoolExecutor(2) as pool:
+                vals = list(pool.map(sample_shared, [node_dir] * 2,
+                                     [points] * 2))
+            for v in vals:
+                self.assertTrue(np.array_equal(v, expected))
+            self.assertRaises(HRDSError, second.set_bands, [1, 2, 1])
+            # a size limit would remove stacks in use, so isn't used
+            other = HRDS(base_raster, rasters=(layer1, layer2),
+                         distances=(7, 4),
+                         node_share=DiskCache(node_dir, max_bytes=1))
+            self.assertEqual(len(stacks()), 2)
+            del other
+            gc.collect()
+            self.assertEqual(len(stacks()), 1)
+            del first
+            gc.collect()
+            self.assertEqual(len(stacks()), 1)
+            del second
+            gc.collect()
+            self.assertEqual(os.listdir(node_dir), [])
+
+    def test_dedup(self):
+        """ Points repeated six times, as the nodes of a discontinuous
+            space would be, give the same values when each is only
+            evaluated once, and the saving is reported. Points within a
+            tolerance of each other are evaluated once too.
+        """
+        bathy = three_layer_stack()
+        points = np.random.RandomState(5).uniform(5, 95, (500, 2))
+        repeated = np.tile(points, (6, 1))
+        expected = bathy.get_vals(repeated)
+        self.assertTrue(np.array_equal(bathy.get_vals(repeated, dedup=True),
+                                       expected))
+        self.assertEqual(bathy.dedup_report,
+                         {"points": 3000, "unique": 500, "ratio": 6.0})
+        # nudge the copies by much less than the tolerance, away from the
+        # edges of the tolerance grid
+        points = np.round(points, 2) + 0.005
+        nudged = np.tile(points, (6, 1)) + np.repeat(
+            np.linspace(-1e-6, 1e-6, 6), 500)[:, None]
+        vals = bathy.get_vals(nudged, dedup=0.01, order="hilbert")
+        self.assertEqual(bathy.dedup_report["unique"], 500)
+        self.assertTrue(np.allclose(vals, bathy.get_vals(nudged)))
+
+    def test_fill_past_base(self):
+        """ A point in the buffer zone of a layer that extends past the
+            base has nothing to blend with there, so gets the layer's
+            value, not the fill value blended in.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            base_file = os.path.join(tmpdir, "base.tif")
+            layer_file = os.path.join(tmpdir, "layer.tif")
+            write_raster(base_file, np.zeros((20, 20)), (0, 20), 1.0)
+            write_raster(layer_file, np.full((20, 20), 1000.0), (10, 20), 1.0)
+            for index_size in (512, None):
+                bathy = HRDS(base_file, rasters=(layer_file,),
+                             distances=(4,), index_size=index_size)
+                bathy.set_bands()
+                points = np.array([[28, 10], [12, 10]])
+                weights = bathy.buffer_stack[0].get_vals(points)[0]
+                self.assertTrue(np.all((weights > 0) & (weights < 1)))
+                vals = bathy.get_vals(points, fill=-9999.0)
+                # outside the base
+                self.assertEqual(vals[0], 1000.0)
+                # blended with the base as usual
+                self.assertTrue(np.allclose(vals[1:], 1000.0*weights[1:]))
+                self.assertRaises(CoordinateError, bathy.get_vals, points)
+                del bathy
+
+    def test_bake(self):
+        """ Bake the stack onto a 0.1 grid, in small blocks. Values at the
+            grid cell centres should be those of the stack, and close to
+            them in between. There is a cell to spare all round the extent,
+            so its corners can be interpolated. Without GDAL, there is
+            nothing to write the raster with.
+        """
+        bathy = three_layer_stack()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            baked_file = os.path.join(tmpdir, "baked.tif")
+            bathy.bake([10.03, 20.03, 40.03, 50.03], 0.1, baked_file,
+                       block_size=64)
+            baked = RasterInterpolator(baked_file)
+            baked.set_band()
+            self.assertEqual(baked.get_array().shape, (302, 302))
+            centres = [[30.58, 40.58], [12.08, 25.08], [39.98, 49.98]]
+            # the baked raster is single precision
+            self.assertTrue(np.allclose(baked.get_vals(centres)[0],
+                                        bathy.get_vals(centres), atol=1e-5))
+            points = ([39.9, 49.9], [28, 32], [13.5, 20.5], [32.5, 45])
+            self.assertTrue(np.allclose(baked.get_vals(points)[0],
+                                        bathy.get_vals(points), atol=0.05))
+            corners = [[10.03, 20.03], [40.03, 20.03], [10.03, 50.03],
+                       [40.03, 50.03]]
+            self.assertTrue(np.allclose(baked.get_vals(corners)[0],
+                                        bathy.get_vals(corners), atol=0.05))
+            for corner in corners:
+                self.assertTrue(np.isclose(baked.get_val(corner),
+                                           bathy.get_val(corner), atol=0.05))
+            del baked
+            with mock.patch.object(hrds.hrds, "gdal", None):
+                self.assertRaises(HRDSError, bathy.bake,
+                                  [10, 20, 40, 50], 0.1, baked_file)
+
+    def test_save_load(self):
+        """ Save the stack (plain and quantized) and load it again. The
+            loaded stack is memory mapped and must give exactly the same
+            values.
+        """
+        points = grid_points()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stack_file = os.path.join(tmpdir, "stack.hrds")
+            for quantize in (None, True):
+                bathy = three_layer_stack(quantize=quantize)
+                bathy.save(stack_file)
+                loaded = HRDS.load(stack_file)
+                self.assertIsInstance(loaded.raster_stack[1].interpolator.val
+                                      if quantize is None else
+                                      loaded.raster_stack[1].val.codes,
+                                      np.memmap)
+                self.assertTrue(np.array_equal(loaded.get_vals(points),
+                                               bathy.get_vals(points)))
+                for p in ([40, 50], [28, 32], [13.5, 20], [32.5, 45]):
+                    self.assertEqual(loaded.get_val(p), bathy.get_val(p))
+                self.assertEqual(loaded.baseRaster.extent,
+                                 bathy.baseRaster.extent)
+                del loaded
+
+    def test_pickle(self):
+        """ A pickled stack gives the same values. Once shared, the
+            rasters are sent as handles to shared memory, so the pickle
+            is small, and worker processes give the same values too.
+        """
+        bathy = three_layer_stack()
+        points = grid_points()
+        expected = bathy.get_vals(points)
+        copy = pickle.loads(pickle.dumps(bathy))
+        self.assertTrue(np.array_equal(copy.get_vals(points), expected))
+        full_size = len(pickle.dumps(bathy))
+        bathy.share()
+        self.assertLess(len(pickle.dumps(bathy)), full_size / 50)
+        with ProcessPoolExecutor(2) as pool:
+            vals = list(pool.map(sample, [bathy] * 3,
+                                 np.array_split(points, 3)))
+        self.assertTrue(np.array_equal(np.concatenate(vals), expected))
+        self.assertEqual(type(bathy.get_vals(points)), np.ndarray)
+
 
 class RealDataTest(unittest.TestCase):
 
@@ -129,6 +629,8 @@ class RealDataTest(unittest.TestCase):
                     ]
         for p, e in zip(points, expected):
             self.assertAlmostEqual(bathy.get_val(p), e, delta=0.75)
+        self.assertTrue(np.array_equal(bathy.get_vals(points),
+                                       [bathy.get_val(p) for p in points]))
 
 
 class RealDataTest_limited(unittest.TestCase):
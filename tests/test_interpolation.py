@@ -4,7 +4,11 @@ import sys
 # make sure we use the devel version first
 sys.path.insert(0,os.path.dirname(os.path.realpath(__file__))+'/..')
 from hrds.raster import RasterInterpolator, CoordinateError, RasterInterpolatorError
-from numpy import array, ones
+from hrds.raster import replace_nans, QuantizedBand
+from numpy import array, ones, isnan, array_equal, nan, float32, int16, uint8
+from numpy import abs as np_abs, memmap
+import pickle
+import tempfile
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -23,6 +27,8 @@ from numpy import array, ones
 
 
 test_file_name1 = os.path.join(os.path.split(__file__)[0], "test_raster.asc")
+test_file_name2 = os.path.join(os.path.split(__file__)[0],
+                               "test_raster_large.tif")
 
 
 class TestRasterInterpolator(unittest.TestCase):
@@ -135,6 +141,156 @@ class TestRasterInterpolator(unittest.TestCase):
         self.assertEqual(rci.get_val(point7),2)
         self.assertRaises(CoordinateError,rci.get_val, point1)
 
+    def test_batch_interpolation(self):
+        """ Same raster as above, but asking for all the points at once.
+            The values should match get_val exactly and points off the
+            raster should be flagged rather than raise an error.
+            """
+        rci = RasterInterpolator(test_file_name1, minmax=[2, 10])
+        points = array([[0.0, 0.0],
+                        [1.5, 2.0],
+                        [2.0, 3.0],
+                        [3, 1],
+                        [1.999999, 2.999999],
+                        [0.5, 0.5],
+                        [1.0, 3.49],
+                        [-1.0, 2.0],
+                        [3.6, 3.6]])
+        self.assertRaises(RasterInterpolatorError, rci.get_vals, points)
+        rci.set_band()
+        vals, outside = rci.get_vals(points)
+        self.assertEqual(list(outside), [True, False, False, False, False,
+                                         False, False, True, True])
+        for p, v, o in zip(points, vals, outside):
+            if o:
+                self.assertRaises(CoordinateError, rci.get_val, p)
+                self.assertTrue(isnan(v))
+            else:
+                self.assertEqual(rci.get_val(p), v)
+
+    def test_lazy_interpolation(self):
+        """ Read the raster in 3x3 blocks, keeping only the last block in
+            memory. Values should be identical to reading the whole
+            raster in one go.
+            """
+        rci = RasterInterpolator(test_file_name1)
+        rci.set_band()
+        lazy = RasterInterpolator(test_file_name1, lazy=True, block_size=3,
+                                  cache_bytes=1)
+        lazy.set_band()
+        points = array([[1.5, 2.0], [2.0, 3.0], [3, 1], [0.5, 0.5],
+                        [1.0, 3.49], [3.2, 3.4], [0.0, 0.0]])
+        for p in points[:-1]:
+            self.assertEqual(lazy.get_val(p), rci.get_val(p))
+        self.assertRaises(CoordinateError, lazy.get_val, points[-1])
+        vals, outside = lazy.get_vals(points)
+        expected, _ = rci.get_vals(points)
+        self.assertTrue(array_equal(vals[:-1], expected[:-1]))
+        self.assertTrue(outside[-1])
+        self.assertEqual(len(lazy.val.blocks), 1)
+        self.assertTrue(array_equal(lazy.get_array(), rci.get_array()))
+
+    def test_native_dtype(self):
+        """ A single precision raster stays single precision, and is not
+            copied to flip it. Values are worked out in double precision
+            all the same, so are the same whichever way they are found.
+            """
+        rci = RasterInterpolator(test_file_name2)
+        rci.set_band()
+        self.assertEqual(rci.get_array().dtype, float32)
+        self.assertIsNotNone(rci.get_array().base)
+        self.assertEqual(rci.get_val([1.3, 2.1]),
+                         rci.get_vals([[1.3, 2.1]])[0][0])
+        data = array([[1, nan], [nan, 4], [5, 6]], dtype=float32)
+        replace_nans(data, -99, rows=2)
+        self.assertTrue(array_equal(data, [[1, -99], [-99, 4], [5, 6]]))
+
+    def test_quantized(self):
+        """ Store the raster as 16 bit integers. Interpolated values should
+            be within the quantization error of those from the original
+            data.
+            """
+        rci = RasterInterpolator(test_file_name2)
+        rci.set_band()
+        quantized = RasterInterpolator(test_file_name2, quantize=int16)
+        quantized.set_band()
+        self.assertEqual(quantized.val.codes.dtype, int16)
+        self.assertLess(quantized.val.nbytes, rci.get_array().nbytes)
+        error = quantized.val.max_error
+        self.assertGreater(error, 0)
+        self.assertLessEqual(np_abs(quantized.get_array() -
+                                    rci.get_array()).max(), error)
+        points = array([[1.3, 2.1], [0.2, 3.85], [2, 2], [3.8, 0.3]])
+        vals, _ = quantized.get_vals(points)
+        expected, _ = rci.get_vals(points)
+        self.assertLessEqual(np_abs(vals - expected).max(), error + 1e-12)
+        for p, v in zip(points, vals):
+            self.assertEqual(quantized.get_val(p), v)
+        self.assertRaises(RasterInterpolatorError, RasterInterpolator,
+                          test_file_name2, lazy=True, quantize=int16)
+
+    def test_quantized_ends(self):
+        """ A buffer stored as bytes is exactly 0 and 1 only where it
+            should be. Weights that would round to 0 or 1 get the codes
+            next to them, so are still blended.
+            """
+        weights = array([[0, 0.001, 0.5], [0.999, 1, 0.0015]])
+        quantized = QuantizedBand(weights, uint8, limits=(0, 1))
+        self.assertEqual(quantized.codes.dtype, uint8)
+        vals = quantized.read()
+        self.assertEqual(vals[0, 0], 0.0)
+        self.assertEqual(vals[1, 1], 1.0)
+        self.assertTrue(all(vals[[0, 1, 0], [1, 0, 2]] > 0))
+        self.assertTrue(all(vals[[0, 1, 0], [1, 0, 2]] < 1))
+        self.assertGreater(vals[1, 2], 0)
+        self.assertLessEqual(np_abs(vals - weights).max(),
+                             quantized.max_error)
+
+    def test_array_cache(self):
+        """ The first time the raster is used it is stored in the cache,
+            and after that it is memory mapped from there, giving the
+            same values.
+            """
+        rci = RasterInterpolator(test_file_name2)
+        rci.set_band()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = RasterInterpolator(test_file_name2, array_cache=tmpdir)
+            first.set_band()
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+            self.assertTrue(array_equal(first.get_array(), rci.get_array()))
+            again = RasterInterpolator(test_file_name2, array_cache=tmpdir)
+            again.set_band()
+            self.assertIsInstance(again.get_array(), memmap)
+            self.assertTrue(array_equal(again.get_array(), rci.get_array()))
+            self.assertEqual(again.get_val([1.3, 2.1]), rci.get_val([1.3, 2.1]))
+            del again
+
+    def test_from_array(self):
+        """ A RasterInterpolator made from the array and extent of
+            another gives the same values, without a raster file.
+            """
+        rci = RasterInterpolator(test_file_name2)
+        rci.set_band()
+        copy = RasterInterpolator.from_array(rci.get_array(), rci.extent,
+                                             rci.dx, rci.nodata)
+        self.assertEqual(copy.get_extent(), rci.get_extent())
+        self.assertEqual(copy.get_box()[0].tolist(), rci.llc.tolist())
+        for p in ([1.3, 2.1], [0.8, 2.0], [2.6, 3.1]):
+            self.assertEqual(copy.get_val(p), rci.get_val(p))
+
+    def test_pickle(self):
+        """ A pickled RasterInterpolator opens its raster again when
+            needed, and gives the same values, lazy or not.
+            """
+        for lazy in (False, True):
+            rci = RasterInterpolator(test_file_name2, lazy=lazy)
+            rci.set_band()
+            copy = pickle.loads(pickle.dumps(rci))
+            # only lazy bands need the raster straight away
+            self.assertEqual(copy._ds is None, not lazy)
+            self.assertEqual(copy.get_val([1.3, 2.1]), rci.get_val([1.3, 2.1]))
+            self.assertEqual(copy.get_extent(), rci.get_extent())
+
 
 if __name__ == '__main__':
     unittest.main()
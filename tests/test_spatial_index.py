@@ -0,0 +1,97 @@
+import unittest
+import os
+import sys
+# make sure we use the devel version first
+sys.path.insert(0,os.path.dirname(os.path.realpath(__file__))+'/..')
+from hrds.spatial_index import RTree, curve_order
+import numpy as np
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright Jon Hill, University of York, jon.hill@york.ac.uk
+
+
+class TestRTree(unittest.TestCase):
+    """Tests the hrds.spatial_index.RTree class"""
+
+    def test_rtree(self):
+        """ Random boxes, enough for a few levels of tree. The boxes found
+            for each point must be exactly those containing it, edges
+            included, whether asked one point at a time or all at once.
+        """
+        rng = np.random.default_rng(42)
+        llc = rng.uniform(0, 100, (500, 2))
+        boxes = np.hstack((llc, llc + rng.uniform(0, 10, (500, 2))))
+        tree = RTree(boxes)
+        self.assertEqual(len(tree.levels), 4)
+        points = rng.uniform(-5, 115, (2000, 2))
+        # a corner and a NaN
+        points[0] = boxes[7, 2:]
+        points[1] = np.nan
+        inside = ((points[:, None, 0] >= boxes[None, :, 0]) &
+                  (points[:, None, 0] <= boxes[None, :, 2]) &
+                  (points[:, None, 1] >= boxes[None, :, 1]) &
+                  (points[:, None, 1] <= boxes[None, :, 3]))
+        pts, found = tree.query_many(points)
+        expected_pts, expected = np.nonzero(inside)
+        self.assertTrue(np.array_equal(pts, expected_pts))
+        self.assertTrue(np.array_equal(found, expected))
+        # in chunks, as very many points are
+        pts, found = tree.query_many(points, chunk_size=37)
+        self.assertTrue(np.array_equal(pts, expected_pts))
+        self.assertTrue(np.array_equal(found, expected))
+        self.assertIn(7, tree.query(points[0]))
+        self.assertEqual(len(tree.query(points[1])), 0)
+        for p, row in zip(points[::50], inside[::50]):
+            self.assertTrue(np.array_equal(tree.query(p),
+                                           np.flatnonzero(row)))
+
+    def test_empty(self):
+        """ A tree of nothing finds nothing """
+        tree = RTree([])
+        self.assertEqual(len(tree.query([0, 0])), 0)
+        pts, found = tree.query_many([[0, 0], [1, 1]])
+        self.assertEqual(len(pts), 0)
+
+
+class TestCurveOrder(unittest.TestCase):
+    """Tests hrds.spatial_index.curve_order"""
+
+    def test_curves(self):
+        """ The cell centres of an 8x8 grid, in a random order, are put
+            in order along each curve. Each step of the Hilbert curve is
+            to a neighbouring cell; the Morton curve is a Z in each
+            quadrant. Points with NaN go last.
+        """
+        x, y = np.meshgrid(np.arange(8) + 0.5, np.arange(8) + 0.5)
+        points = np.column_stack((x.ravel(), y.ravel()))
+        points = points[np.random.RandomState(3).permutation(64)]
+        steps = np.diff(points[curve_order(points, [0, 0, 8, 8],
+                                           bits=3)], axis=0)
+        self.assertTrue(np.array_equal(np.abs(steps).sum(axis=1),
+                                       np.ones(63)))
+        morton = points[curve_order(points, [0, 0, 8, 8], "morton", 3)]
+        self.assertEqual(morton[:4].tolist(), [[0.5, 0.5], [1.5, 0.5],
+                                               [0.5, 1.5], [1.5, 1.5]])
+        points[10] = np.nan
+        for curve in ("hilbert", "morton"):
+            order = curve_order(points, [0, 0, 8, 8], curve)
+            self.assertEqual(sorted(order), list(range(64)))
+            self.assertEqual(order[-1], 10)
+        self.assertRaises(ValueError, curve_order, points, [0, 0, 8, 8],
+                          "peano")
+
+
+if __name__ == '__main__':
+    unittest.main()